@@ -11,6 +11,12 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
+import interval_index as ii
+import lookup_cache
+import nclist
+import overlap_batch
+import pipeline
+import sweep
 import utils as u
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
@@ -52,27 +58,9 @@ def collapseRefSeq(line):
     return  ';'.join(collapsed)
 
 
-def binarySearchUniqueAndSorted(arg0, key):
-    low = 0;
-    high = len(arg0) - 1
-    mid = 0;
-    obj = 0;
-
-    while (low <= high):
-        mid = (low + high) / 2
-        obj = arg0[mid]
-
-        if (obj < key):
-            low = mid + 1;
-        elif (obj > key):
-            high = mid - 1;
-        else:
-            return mid;
-
-    return -1 # NOT_FOUND
-
-
-"""Cleans characters not accepted by MySQL
+"""Strips quotes from VCF fields
+   Queries are parameterized (see queries.py), so this is no longer needed
+   for escaping; it is kept so REF/ALT are matched as before.
 """
 def clean_mysql_chars(entry):
     entry = entry.replace("\"", "")
@@ -107,47 +95,113 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
+"""Looks up a batch of variants in dbSNP with one query per chromosome
+   db is a queries.Queries; variants is a list of (chr, pos) pairs.
+   Returns a dict keyed by (chr, pos) holding the (REF, row) pairs found
+   for that position. With a lookup_cache.LRUCache only the positions
+   not cached are queried.
+"""
+def lookupDbSnpBatch(db, variants, varclass='SNV', cache=None):
+    found = {}
+    by_chr = {}
+    for (chr, pos) in variants:
+        if (chr, pos) in found:
+            continue
+        pairs = lookup_cache.MISS if cache is None else \
+            cache.get(('dbSNP', varclass, chr, pos))
+        if pairs is lookup_cache.MISS:
+            by_chr.setdefault(chr, set()).add(pos)
+        else:
+            found[(chr, pos)] = pairs
+
+    for chr, positions in by_chr.items():
+        rows = db.fetchall('dbsnp_by_positions', [chr, varclass],
+            values=sorted(positions))
+        fetched = {}
+        for row in rows:
+            fetched.setdefault(int(row[0]), []).append((str(row[1]), row[2:]))
+        for pos in positions:
+            pairs = tuple(fetched.get(pos, ()))
+            found[(chr, pos)] = pairs
+            if cache is not None:
+                cache.put(('dbSNP', varclass, chr, pos), pairs)
+
+    return found
+
+
+"""Base class of the record annotators
+   An annotator edits the ID/INFO fields of the pipeline.Records it is
+   given and keeps the counts it reports in the .count.log. db, a
+   queries.Queries, is set by the pipeline before the first batch when
+   uses_database(). Rows fetched per position are kept in cache, shared
+   by every annotator of the process (see lookup_cache.py). While tally
+   is a dict, the counts are also added up per record in it, keyed by
+   the record being annotated (current).
+"""
+class Annotator(object):
+    def __init__(self):
+        self.db = None
+        self.cache = lookup_cache.CACHE
+        self.counts = {}
+        self.current = None
+        self.tally = None
+
+    def uses_database(self):
+        return True
+
+    def count(self, key, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+        if self.tally is not None:
+            counts = self.tally.setdefault(self.current, {})
+            counts[key] = counts.get(key, 0) + n
+
+    """Cached result of fetch() for key
+    """
+    def cached(self, key, fetch):
+        value = self.cache.get(key)
+        if value is lookup_cache.MISS:
+            value = fetch()
+            self.cache.put(key, value)
+        return value
+
+    def annotate(self, records):
+        for record in records:
+            self.current = record
+            self.annotate_record(record)
+
+    def annotate_record(self, record):
+        raise NotImplementedError
+
+    """Lines for the .count.log
+    """
+    def summary(self):
+        return []
+
+
+""""Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    Each batch is resolved with a single query per chromosome
+    (see lookupDbSnpBatch)
+"""
+class DbSnpAnnotator(Annotator):
+    def __init__(self, varclass='SNV'):
+        Annotator.__init__(self)
+        self.varclass = varclass
+
+    def annotate(self, records):
+        found = lookupDbSnpBatch(self.db,
+            [(r.chrom, r.pos) for r in records], varclass=self.varclass,
+            cache=self.cache)
+
+        for record in records:
+            self.current = record
+            fields = record.fields
+            ref = clean_mysql_chars(record.ref).strip()
+            refs = (ref.upper(), getComplementary(ref).upper())
+            rows = [row for (row_ref, row) in found.get((record.chrom, record.pos), [])
+                if row_ref.upper() in refs]
+            self.count('variants')
+
+            ## reset rsid to "." - in case there was annotation from old release of dbSNP
             fields[2] = '.'
             rsids = []
             mafs = []
@@ -161,35 +215,24 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
                 if (len(mafs) > 0):
                     maf_str = ';' + ';'.join([str(x) for x in mafs])
 
-                var_count = var_count + 1
+                self.count('dbsnp')
                 if (str(fields[7]) == '.'):
                     fields[7] = 'DB' + maf_str
                 else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+                    fields[7] = fields[7] + ';DB;VC=' + self.varclass + maf_str
 
                 fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
-
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def summary(self):
+        # Line numbering of the original per-file loop started at 1
+        linenum = self.counts.get('variants', 0) + 1
+        var_count = self.counts.get('dbsnp', 0)
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        return [
+            "## Please notice that all Isoforms were counted",
+            "## Numbers may exceed number of variants in the annotated file",
+            f"Total: {str(linenum)}",
+            f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)"]
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,1205 +240,759 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
+class BigRefGeneAnnotator(Annotator):
+    def annotate_record(self, record):
+        fields = record.fields
+        chr = record.chrom
+        pos = record.pos
+        ref = clean_mysql_chars(record.ref).strip()
+        alt = clean_mysql_chars(record.alt).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        lookups = (
+            ('bigrefgene_equal_base', [chr, pos, ref, alt, compRef, compAlt]),
+            ('bigrefgene_equal_nobase', [chr, pos]),
+            ('bigrefgene_unequal', [chr, pos, pos]))
+
+        rows = self.cached(('bigRefGene', chr, pos, ref, alt),
+            lambda: self.lookup(lookups))
+
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+
+            fields[7] = fields[7] + ';' + ';'.join(m)
+            if (str(fields[7]).startswith(".;")):
+                fields[7] = str(fields[7]).replace('.;', '', 1)
+
+    """Rows of the first of the lookups that finds any
+    """
+    def lookup(self, lookups):
+        for (name, params) in lookups:
+            rows = self.db.fetchall(name, params)
             if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+                return rows
+        return ()
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+"""cpgIslandExt held in memory for promoter classification
+   The islands of a chromosome are read in one query on first use and
+   kept in lookup_cache.MODELS for the later jobs of the process.
+"""
+class CpgIslands(object):
+    def __init__(self, db):
+        self.db = db
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+    def _build(self, chrom):
+        rows = self.db.fetchall('cpg_islands_of_chrom', [chrom])
+        return ii.Intervals.from_rows(
+            [(int(row[0]), int(row[1]), row[2:]) for row in rows])
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    """First island overlapping pos as (chrom, chromStart, chromEnd, name),
+       or None
+    """
+    def first(self, chrom, pos):
+        intervals = lookup_cache.MODELS.get(('cpgIslandExt', chrom),
+            lambda: self._build(chrom))
+        return intervals.first(int(pos))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+"""Comma separated exonStarts/exonEnds blob as a list of ints
+"""
+def decodePositions(blob):
+    if isinstance(blob, bytes):
+        blob = blob.decode('utf-8')
+    return [int(x) for x in str(blob).split(',') if len(x.strip()) > 0]
 
-            if (keep_going):
-                fh_out.write(line + '\n')
 
-            vcf_linenum = vcf_linenum + 1
+"""A refGene row with its exons decoded once
+   exons holds the exon indices as interval_index.Intervals, so the
+   exons containing a position are found by bisection.
+"""
+class Transcript(object):
+    __slots__ = ('row', 'strand', 'txStart', 'txEnd', 'cdsStart', 'cdsEnd',
+        'exonCount', 'exons')
+
+    def __init__(self, row):
+        self.row = row
+        self.strand = str(row[3])
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        starts = decodePositions(row[9])[:self.exonCount]
+        ends = decodePositions(row[10])[:self.exonCount]
+        self.exons = ii.Intervals.from_rows(
+            [(start, end, e) for (e, (start, end)) in enumerate(zip(starts, ends))])
+
+    """Numbers of the exons containing pos, counted along the strand
+    """
+    def exonNumbers(self, pos):
+        numbers = []
+        for e in sorted(self.exons.overlapping(pos)):
+            if (self.strand == '-'):
+                numbers.append(self.exonCount - e)
+            else:
+                numbers.append(e + 1)
+        return numbers
 
-        else:
-            fh_out.write(line + '\n')
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Transcript models of a gene table, built once per chromosome on first
+   use and searched in memory
+   Each transcript is indexed over its promoter-extended span,
+   txStart - promoter_offset to txEnd + promoter_offset. The models are
+   kept in lookup_cache.MODELS, so the later jobs of the process (and of
+   the same reference version) reuse them.
+"""
+class TranscriptModels(object):
+    def __init__(self, db, table='refGene', promoter_offset=500):
+        self.db = db
+        self.table = table
+        self.promoter_offset = int(promoter_offset)
+
+    def _build(self, chrom):
+        rows = self.db.fetchall('transcripts_of_chrom', [chrom],
+            table=self.table)
+        offset = self.promoter_offset
+        models = [Transcript(row) for row in rows]
+        return ii.Intervals.from_rows([(t.txStart - offset,
+            t.txEnd + offset, t) for t in models])
+
+    """Transcripts whose promoter-extended span contains pos
+    """
+    def near(self, chrom, pos):
+        intervals = lookup_cache.MODELS.get(('transcripts', self.table,
+            self.promoter_offset, chrom), lambda: self._build(chrom))
+        return intervals.overlapping(int(pos))
 
 
 """Get information about location in gene structures
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+class GenesAnnotator(Annotator):
+    def __init__(self, table='refGene', promoter_offset=500):
+        Annotator.__init__(self)
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.models = None
+        self.islands = None
+
+    def annotate_record(self, record):
+        fields = record.fields
+        chr = record.ucsc_chrom
+        pos = record.pos
+        promoter_offset = self.promoter_offset
+        info_field = clean_mysql_chars(fields[7]).strip()
+
+        if self.models is None:
+            self.models = TranscriptModels(self.db, self.table, promoter_offset)
+            self.islands = CpgIslands(self.db)
+        transcripts = self.models.near(chr, pos)
+        info = []
+
+        if (len(transcripts) > 0):
+            cnt = 1
+            for tx in transcripts:
+                row = tx.row
+                #count location
+                positionType = str(u.parse_field(info_field, 
+                    'positionType', ';', '='))
+                
+                if (positionType == 'intron'):
+                    self.count('intronic')
+                elif (positionType == 'non_coding_intron'):
+                    self.count('non_coding_intronic')
+                elif (positionType == 'CDS'):
+                    self.count('cds')
+                elif (positionType == 'non_coding_exon'):
+                    self.count('non_coding_exonic')
+                elif (positionType == 'utr5'):
+                    self.count('utr5')
+                elif (positionType == 'utr3'):
+                    self.count('utr3')
+
+                txtStart = tx.txStart
+                txtEnd = tx.txEnd
+                cdsStart = tx.cdsStart
+                cdsEnd = tx.cdsEnd
+                exonCount = tx.exonCount
+                strand = tx.strand
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+
+                if (cdsStart == cdsEnd):
+                    exons = ["non_coding_exon=" + "ex" + str(exnum) + '/' + \
+                        str(exonCount) for exnum in tx.exonNumbers(pos)]
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                    exons = ["exon=" + "ex" + str(exnum) + '/' + \
+                        str(exonCount) for exnum in tx.exonNumbers(pos)]
+                    if (len(exons) > 0):
+                        self.count('exonic', len(exons))
+                        region = ";".join(exons)
+
+                elif ((u.isBetween(pos, promoter_plus, txtStart) and 
+                    (strand == "+")) or 
+                    (u.isBetween(pos, txtEnd, promoter_minus) and 
+                    (strand == "-"))):
+                    island = self.islands.first(chr, pos)
+
+                    if (island is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(island[3]).split())
+                        self.count('promoter')
+
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row, 
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+
+                cnt = cnt + 1
+
+            str_info = ";".join(info)
+            fields[7] = fields[7] + ';' + str_info
 
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+        else:
+            fields[7] = fields[7] + ";positionType=interGenic"
+            self.count('interGenic')
+
+    def summary(self):
+        c = self.counts
+        lines = [
+            "Variants located:",
+            f"In interGenic {str(c.get('interGenic', 0))}",
+            f"In CDS {str(c.get('cds', 0))}",
+            f"In \'3 UTR {str(c.get('utr3', 0))}",
+            f"In \'5 UTR {str(c.get('utr5', 0))}",
+            f"In Intronic {str(c.get('intronic', 0))}",
+            f"In Non_coding_intronic {str(c.get('non_coding_intronic', 0))}",
+            f"In Exonic {str(c.get('exonic', 0))}",
+            f"In Non_coding_exonic {str(c.get('non_coding_exonic', 0))}",
+            f"In Putative Promoter Region {str(c.get('promoter', 0))}"]
+        for line in lines:
+            print(line)
+        return lines
+
+
+"""Base class of the annotators that look up the reference intervals
+   overlapping each variant. Without an index each lookup is a range
+   query on table; with an interval_index.IntervalIndex of the table
+   no database access is needed. After enable_sweep() lookups on sorted
+   input are answered by a sweep.SweepJoin instead. After enable_batch()
+   the intervals of each chromosome are held as overlap_batch arrays and
+   a whole batch of records is resolved at once before annotating it.
+   After enable_nclist() they are held as an nclist.NCList per chromosome.
+"""
+class OverlapAnnotator(Annotator):
+    chrom_column = 'chrom'
+    start_column = 'chromStart'
+    end_column = 'chromEnd'
+
+    def __init__(self, table, index=None):
+        Annotator.__init__(self)
+        self.table = table
+        self.index = index
+        self.sweep = None
+        self.batch = None
+        self.nclists = None
+        self._resolved = None
+
+    def uses_database(self):
+        return self.index is None
+
+    def enable_sweep(self):
+        self.sweep = sweep.SweepJoin(self.intervals, name=self.table)
+
+    def enable_nclist(self):
+        self.nclists = {}
+
+    """Does nothing when numpy is not installed
+    """
+    def enable_batch(self):
+        if overlap_batch.available():
+            self.batch = {}
+
+    """(chrom, pos) the stage looks up for record, or None if it skips it
+    """
+    def lookup_key(self, record):
+        return (record.ucsc_chrom, record.pos)
+
+    def annotate(self, records):
+        if self.batch is not None:
+            self._resolved = self.resolve(records)
+        try:
+            Annotator.annotate(self, records)
+        finally:
+            self._resolved = None
+
+    """Overlapping rows of every record, keyed by lookup_key, computed
+       one chromosome at a time
+    """
+    def resolve(self, records):
+        by_chrom = {}
+        for record in records:
+            key = self.lookup_key(record)
+            if key is not None:
+                by_chrom.setdefault(key[0], set()).add(key[1])
+
+        resolved = {}
+        for chrom, positions in by_chrom.items():
+            if chrom not in self.batch:
+                if self.index is not None:
+                    intervals = self.index.chrom(chrom)
+                    if (intervals is not None) and \
+                        not isinstance(intervals, ii.Intervals):
+                        intervals = ii.Intervals.from_rows(intervals.items())
+                else:
+                    intervals = ii.Intervals.from_rows(self.intervals(chrom))
+                self.batch[chrom] = None if intervals is None else \
+                    overlap_batch.BatchIntervals(intervals)
 
+            positions = sorted(positions)
+            if self.batch[chrom] is None:
+                rows = [[] for pos in positions]
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
-
+                rows = self.batch[chrom].overlapping(positions)
+            for (pos, pos_rows) in zip(positions, rows):
+                resolved[(chrom, pos)] = pos_rows
+        return resolved
+
+    """Table and column names filled into the statements of chrom
+    """
+    def identifiers(self, chrom):
+        return {'table': self.table, 'chrom': self.chrom_column,
+            'start': self.start_column, 'end': self.end_column}
+
+    """Statement name and parameters of the rows overlapping pos
+    """
+    def query(self, chrom, pos):
+        return ('overlap', [chrom, pos, pos])
+
+    """Statement name and parameters of all intervals of chrom in start
+       order, the start and end columns selected ahead of the table row
+    """
+    def stream_query(self, chrom):
+        return ('intervals_of_chrom', [chrom])
+
+    def _fetch(self, query, chrom):
+        (name, params) = query
+        return self.db.execute(name, params, **self.identifiers(chrom))
+
+    """Rows of a query in interval_index.in_row_order, the order the
+       index, sweep, batch and NCList lookups return them in
+    """
+    def _fetch_rows(self, query, chrom):
+        cursor = self._fetch(query, chrom)
+        rows = cursor.fetchall()
+        if (len(rows) < 2):
+            return rows
+        names = [d[0] for d in cursor.description]
+        (s, e) = (names.index(self.start_column), names.index(self.end_column))
+        return [row for (start, end, row) in
+            ii.in_row_order([(row[s], row[e], row) for row in rows])]
+
+    """(start, end, row) triples of chrom in interval_index.in_row_order
+    """
+    def intervals(self, chrom):
+        if self.index is not None:
+            intervals = self.index.chrom(chrom)
+            if intervals is None:
+                return
+            for item in intervals.items():
+                yield item
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+            rows = self._fetch(self.stream_query(chrom), chrom).fetchall()
+            for item in ii.in_row_order([(int(row[0]), int(row[1]), row[2:])
+                for row in rows]):
+                yield item
+
+    """NCList of chrom, built on first use
+    """
+    def nclist(self, chrom):
+        if chrom not in self.nclists:
+            self.nclists[chrom] = nclist.NCList.from_rows(self.intervals(chrom))
+        return self.nclists[chrom]
+
+    """All rows overlapping pos (fetchall)
+    """
+    def overlapping(self, chrom, pos):
+        if (self._resolved is not None) and ((chrom, pos) in self._resolved):
+            return self._resolved[(chrom, pos)]
+        if (self.sweep is not None) and self.sweep.accepts(chrom, pos):
+            return self.sweep.overlapping(chrom, pos)
+        if self.nclists is not None:
+            return self.nclist(chrom).overlapping(int(pos))
+        if self.index is not None:
+            return self.index.overlapping(chrom, pos)
+        return self.cached((self.table, chrom, pos),
+            lambda: self._fetch_rows(self.query(chrom, pos), chrom))
+
+    """First row overlapping pos, or None (fetchone)
+    """
+    def first(self, chrom, pos):
+        if (self._resolved is not None) and ((chrom, pos) in self._resolved):
+            rows = self._resolved[(chrom, pos)]
+            return rows[0] if (len(rows) > 0) else None
+        if (self.sweep is not None) and self.sweep.accepts(chrom, pos):
+            return self.sweep.first(chrom, pos)
+        if self.nclists is not None:
+            return self.nclist(chrom).first(int(pos))
+        if self.index is not None:
+            return self.index.first(chrom, pos)
+        rows = self.cached((self.table, chrom, pos),
+            lambda: self._fetch_rows(self.query(chrom, pos), chrom))
+        return rows[0] if (len(rows) > 0) else None
+
+    def summary(self):
+        return [f"In {str(self.table)}: {str(self.counts.get('var', 0))} in " + \
+            f"{str(self.counts.get('line', 0))} variants"]
+
+
+"""Appends records to the INFO field, with ';' unless it already ends with one
+"""
+def appendInfo(fields, text):
+    if str(fields[7]).endswith(';'):
+        fields[7] = fields[7] + text
+    else:
+        fields[7] = fields[7] + ';' + text
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+"""Overlap with tfbsConsSites
+   Sites are split in one table per chromosome
+"""
+class TfbsConsSitesAnnotator(OverlapAnnotator):
+    allowed_chrom = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    def __init__(self, table='tfbsConsSites'):
+        OverlapAnnotator.__init__(self, table)
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    def lookup_key(self, record):
+        if (record.chrom in self.allowed_chrom):
+            return (record.chrom, record.pos)
+        return None
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+    def identifiers(self, chrom):
+        return {'table': 'tfbsConsSites' + chrom}
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+    def query(self, chrom, pos):
+        return ('tfbs_overlap', [pos, pos])
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    def stream_query(self, chrom):
+        return ('tfbs_intervals', [])
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    def annotate_record(self, record):
+        if (record.chrom in self.allowed_chrom):
+            rows = self.overlapping(record.chrom, record.pos)
+            records = []
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+            if (len(rows) > 0):
+                self.count('line')
+                for row in rows:
+                    self.count('var')
+                    t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                        str(row[1]) + '.' + str(row[2])
+                    t = t.strip()
+                    records.append('tfbsRegion' + '=' + t)
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+                appendInfo(record.fields, ';'.join(records))
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""Overlap with GadAll table
+   For some reason this table has no "chr" preceeding number
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+class GadAllAnnotator(OverlapAnnotator):
+    chrom_column = 'chromosome'
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+    def __init__(self, table='gadAll', index=None):
+        OverlapAnnotator.__init__(self, table, index=index)
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+    def lookup_key(self, record):
+        return (record.chrom, record.pos)
 
-            linenum = linenum + 1
+    def annotate_record(self, record):
+        rows = self.overlapping(record.chrom, record.pos)
+        records = []
 
-        else:
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            self.count('line')
+            r_tmp = []
+            for row in rows:
+                self.count('var')
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]) )
+                    records.append(str(self.table) + '=' + str(row[3]))
+            appendInfo(record.fields, ';'.join(records))
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+""" Overlap with gwasCatalog table """
+class GwasCatalogAnnotator(OverlapAnnotator):
+    # Variants match on the end alone (see gwas_at)
+    start_column = 'chromEnd'
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    def __init__(self, table='gwasCatalog'):
+        OverlapAnnotator.__init__(self, table)
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    def query(self, chrom, pos):
+        return ('gwas_at', [chrom, pos])
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    def stream_query(self, chrom):
+        return ('gwas_intervals', [chrom])
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+    def annotate_record(self, record):
+        rows = self.overlapping(record.ucsc_chrom, record.pos)
+        records = []
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        if (len(rows) > 0):
+            self.count('line')
+            for row in rows:
+                self.count('var')
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            appendInfo(record.fields, ';'.join(records))
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
+class HugoAnnotator(OverlapAnnotator):
+    def __init__(self, table='hugo', index=None):
+        OverlapAnnotator.__init__(self, table, index=index)
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    def annotate_record(self, record):
+        rows = self.overlapping(record.ucsc_chrom, record.pos)
+        records = []
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        if (len(rows) > 0):
+            self.count('line')
+            r_tmp = []
+            for row in rows:
+                self.count('var')
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
+            records_str = ','.join(records).replace(';', ',')
+            appendInfo(record.fields, records_str)
 
-"""Overlap with tfbsConsSites
-"""
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
+"""Overlap with segdup regions genomicSuperDups
+"""
+class GenomicSuperDupsAnnotator(OverlapAnnotator):
+    def __init__(self, table='genomicSuperDups', index=None):
+        OverlapAnnotator.__init__(self, table, index=index)
+
+    def annotate_record(self, record):
+        fields = record.fields
+        rows = self.first(record.ucsc_chrom, record.pos)
+
+        if rows is not None:
+            self.count('line')
+            self.count('var')
+            isOverlap = True
+            otherChrom = rows[7]
+            otherStart = rows[8]
+            otherEnd = rows[9]
+            fields[7] = fields[7] + ';' + str(self.table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Searches Genes Databases and returns Genes/Cytobands 
+   with which SNP or INDEL overlaps
+"""
+class RefGeneAnnotator(OverlapAnnotator):
+    start_column = 'txStart'
+    end_column = 'txEnd'
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def __init__(self, table='refGene'):
+        OverlapAnnotator.__init__(self, table)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    def annotate_record(self, record):
+        colindex = 1
+        colindex2 = 12
+        name = 'name'
+        name2 = 'name2'
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+        rows = self.overlapping(record.ucsc_chrom, record.pos)
+        overlapsWith = []
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            self.count('line')
+            for row in rows:
+                self.count('var')
+                overlapsWith.append(name2 + '=' + \
+                    str(row[colindex2]) + ';' + name + '=' + \
+                    str(row[colindex]))
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+            genes = ';'.join([str(x) for x in overlapsWith])
+            appendInfo(record.fields, str(genes))
 
 
-"""Overlap with GadAll table
+"""Method to find overlap with Cytoband table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+class CytobandAnnotator(OverlapAnnotator):
+    def __init__(self, table='cytoBand', index=None):
+        OverlapAnnotator.__init__(self, table, index=index)
+        self.colindex = 12
+        self.start_column = 'txStart'
+        self.end_column = 'txEnd'
+
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.start_column = 'chromStart'
+            self.end_column = 'chromEnd'
+
+    def annotate_record(self, record):
+        rows = self.overlapping(record.ucsc_chrom, record.pos)
+        overlapsWith = []
+
+        if (len(rows) > 0):
+            self.count('line')
+            for row in rows:
+                self.count('var')
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+            appendInfo(record.fields, str(self.table) + '=' + str(cytoband))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+"""Method to find overlap with CNV tables
+"""
+class CnvAnnotator(OverlapAnnotator):
+    def __init__(self, table='dgv_Cnv', index=None):
+        OverlapAnnotator.__init__(self, table, index=index)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def annotate_record(self, record):
+        rows = self.first(record.ucsc_chrom, record.pos)
 
+        if rows is not None:
+            self.count('line')
+            self.count('var')
+            isOverlap = True
+            appendInfo(record.fields, str(self.table) + '=' + str(isOverlap))
 
-""" Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Method to find overlap with targetScanS tables
+"""
+class MiRNAAnnotator(OverlapAnnotator):
+    def __init__(self, table='targetScanS', index=None):
+        OverlapAnnotator.__init__(self, table, index=index)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def annotate_record(self, record):
+        rows = self.first(record.ucsc_chrom, record.pos)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if rows is not None:
+            self.count('line')
+            self.count('var')
+            t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                str(rows[2]) + '_' + str(rows[3])
+            t = 'miRNAsites=' + t.strip()
+            appendInfo(record.fields, t)
 
+    def summary(self):
+        return [f"In miRNAsites: {str(self.counts.get('var', 0))} in " + \
+            f"{str(self.counts.get('line', 0))} variants"]
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
-"""
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Runs a single annotator over vcf + tmpextin into vcf + tmpextout
+   This is how the stages were chained through temp files before the
+   fused pipeline (see driver.run); counts go to vcf + '.count.log'.
+"""
+def annotateFile(annotator, vcf, format='vcf', tmpextin='', tmpextout='.1',
+    sep='\t', logmode='a', batch_size=1000, backend=None):
+    pipeline.run([annotator], vcf + tmpextin, vcf + tmpextout,
+        vcf + '.count.log', format=format, sep=sep, batch_size=batch_size,
+        logmode=logmode, backend=backend)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+""""Format must be pileup or vcf
+""" 
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=1000):
+    annotateFile(DbSnpAnnotator(varclass=varclass), vcf, format=format,
+        tmpextin='', tmpextout=tmpextout, sep=sep, logmode='w',
+        batch_size=batch_size)
 
 
-"""Overlap with segdup regions genomicSuperDups
-"""
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    annotateFile(BigRefGeneAnnotator(), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    annotateFile(GenesAnnotator(table=table, promoter_offset=promoter_offset),
+        vcf, format=format, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
-   with which SNP or INDEL overlaps
+"""Method used in INDELS, where bigRefGeneTable is not applicable
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = 'name'
-    name2 = 'name2'
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t', backend=None):
+    annotateFile(GenesAnnotator(table=table, promoter_offset=promoter_offset),
+        vcf, format=format, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep,
+        backend=backend)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    annotateFile(TfbsConsSitesAnnotator(table=table), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
+
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t', index=None):
+    annotateFile(GadAllAnnotator(table=table, index=index), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
-"""Method to find overlap with Cytoband table
-"""
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
+    annotateFile(GwasCatalogAnnotator(table=table), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t', index=None):
+    annotateFile(HugoAnnotator(table=table, index=index), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
+
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t', 
+    index=None):
+    annotateFile(GenomicSuperDupsAnnotator(table=table, index=index), vcf,
+        format=format, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
 
-"""Method to find overlap with CNV tables
-"""
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    annotateFile(RefGeneAnnotator(table=table), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
+
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t', index=None):
+    annotateFile(CytobandAnnotator(table=table, index=index), vcf,
+        format=format, tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t', index=None):
+    annotateFile(CnvAnnotator(table=table, index=index), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-"""Method to find overlap with targetScanS tables
-"""
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t', index=None):
+    annotateFile(MiRNAAnnotator(table=table, index=index), vcf, format=format,
+        tmpextin=tmpextin, tmpextout=tmpextout, sep=sep)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
\ No newline at end of file
+### EOF
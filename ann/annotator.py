@@ -1,4 +1,7 @@
-import boto3, json, subprocess, os
+import asyncio, boto3, json, multiprocessing, os
+import run
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from botocore.config import Config
 from botocore.exceptions import ClientError
 from configparser import SafeConfigParser
@@ -33,87 +36,350 @@ def make_new_directory(file_path: str):
 new_dir = config['annotation_output']['OutputFolder']
 make_new_directory(new_dir)
 
-if __name__ == '__main__':
-    # poll SQS message queue
+def default_max_jobs() -> int:
+    """
+    Number of jobs this instance can run at once: one per CPU (or per
+    Workers CPUs when jobs are split across processes), as long as each
+    gets JobMemoryMB of the memory available now
+    """
+    cpus = os.cpu_count() or 1
+    workers = int(config['annotation']['Workers']) or cpus
+    by_cpu = cpus // max(1, workers)
+    available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    by_memory = available // (int(config['annotator']['JobMemoryMB']) * 1024 * 1024)
+    return max(1, min(by_cpu, by_memory))
+
+# Annotation jobs this worker downloads, launches and monitors at once
+max_jobs = int(config['annotator']['MaxConcurrentJobs']) or default_max_jobs()
+
+class JobExecutor(object):
+    """
+    Runs at most max_jobs annotation jobs at once. A slot is reserved
+    before a message is received and given back when its job exits, so
+    the worker stops taking requests off the queue while it is full.
+
+    With warm set, jobs run in a pool of max_jobs processes forked from a
+    forkserver that has already imported run.py and its dependencies;
+    each process connects to AWS and opens the reference backend once
+    (run.init_worker) and keeps them, with its lookup cache and interval
+    indexes, for every job it runs. Otherwise every job is a new
+    `python run.py` process.
+    """
+    def __init__(self, max_jobs: int, warm: bool = False):
+        self.max_jobs = max_jobs
+        self.slots = asyncio.Semaphore(max_jobs)
+        self.running = {}
+        self.tasks = set()
+        self.succeeded = 0
+        self.failed = 0
+        self.pool = self.start_pool() if warm else None
+
+    def start_pool(self) -> ProcessPoolExecutor:
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['run'])
+        pool = ProcessPoolExecutor(max_workers=self.max_jobs, mp_context=context,
+            initializer=run.init_worker)
+        # start every process now rather than on the first jobs
+        for i in range(self.max_jobs):
+            pool.submit(os.getpid)
+        return pool
+
+    async def reserve(self, most: int = 1) -> int:
+        """
+        Waits for a free slot, then takes up to most of the free ones;
+        returns how many were reserved
+        """
+        await self.slots.acquire()
+        count = 1
+        while (count < most) and not self.slots.locked():
+            await self.slots.acquire()
+            count = count + 1
+        return count
+
+    def release(self, count: int = 1):
+        for i in range(count):
+            self.slots.release()
+
+    def submit(self, handler):
+        """
+        Runs handler (a coroutine) as a task holding one reserved slot
+        """
+        async def run():
+            try:
+                await handler
+            finally:
+                self.release()
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def launch(self, input_path: str, job: dict):
+        """
+        Starts a job as `python run.py`, or as run.run_job in a warm process
+        """
+        job_id = job["job_id"]
+        if self.pool is None:
+            # execute run.py subprocess for this job
+            submit_command = ['python', 'run.py', input_path, "--parameter1", job_id, "--parameter2", job["input_file_name"], "--parameter3", job["user_id"], "--parameter4", job["user_email"], "--parameter5", job["user_role"] or ""]
+            if not os.path.isfile("run.py"):
+                raise FileNotFoundError("run.py not found")
+            process = await asyncio.create_subprocess_exec(*submit_command)
+            self.running[job_id] = (asyncio.ensure_future(process.wait()), None)
+        else:
+            future = asyncio.get_running_loop().run_in_executor(self.pool,
+                run.run_job, input_path, job_id, job["input_file_name"],
+                job["user_id"], job["user_email"], job["user_role"])
+            self.running[job_id] = (future, self.pool)
+
+    async def wait(self, job_id: str) -> int:
+        """
+        Waits for a job to finish and records its exit status
+        """
+        (future, pool) = self.running[job_id]
+        try:
+            returncode = await future
+        except BrokenProcessPool:
+            # a warm process died; replace the pool once for all its jobs
+            print(f"Annotation worker process died running {job_id}")
+            if (pool is self.pool):
+                pool.shutdown(wait=False)
+                self.pool = self.start_pool()
+            returncode = 1
+        except Exception as e:
+            print(f"Error when running annotation for {job_id}: {e}")
+            returncode = 1
+        del self.running[job_id]
+        if (returncode == 0):
+            self.succeeded = self.succeeded + 1
+        else:
+            self.failed = self.failed + 1
+        print(f"Annotation job {job_id} exited with status {returncode} " + \
+            f"({len(self.running)} of {self.max_jobs} slots in use)")
+        return returncode
+
+def parse_message(message: dict) -> dict:
+    """
+    Extracts the job parameters from an SQS message; raises KeyError if
+    one is missing
+    """
+    payload = json.loads(message["Body"])
+    message_body = json.loads(payload.get("Message"))
+    return {
+        "job_id": message_body["job_id"],
+        "input_file_name": message_body["input_file_name"],
+        "s3_bucket": message_body["s3_inputs_bucket"],
+        "s3_key": message_body["s3_key_input_file"],
+        "user_id": message_body["user_id"],
+        "user_email": message_body["user_email"],
+        # requests made before roles were sent have none
+        "user_role": message_body.get("user_role"),
+        "message_id": payload["MessageId"],
+        "receipt_handle": message["ReceiptHandle"]
+    }
+
+def download_input(job: dict) -> str:
+    """
+    Downloads the input file of a job into a folder unique to its job id;
+    returns its local path
+    """
+    # make a new sub-directory for this job so can persist unique outfiles
+    new_job_directory = config['annotation_output']['OutputFolder'] + '/' + job["job_id"]
+    make_new_directory(new_job_directory)
+    downloaded_file_path = new_job_directory + "/" + job["input_file_name"]
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+    with open(downloaded_file_path, 'wb') as f:
+        s3_client.download_fileobj(job["s3_bucket"], job["s3_key"], f)
+    return downloaded_file_path
+
+# SQS receives, deletes and changes visibility of at most 10 messages per call
+SQS_BATCH = 10
+
+def sqs_entries(receipt_handles: list, **fields) -> list:
+    return [dict(Id=str(i), ReceiptHandle=handle, **fields)
+        for (i, handle) in enumerate(receipt_handles)]
+
+class QueueMessages(object):
+    """
+    The job request messages this worker has received. While their jobs
+    are in progress their visibility timeout is extended every
+    HeartbeatSeconds, so they are not handed to another worker; a message
+    is deleted, in batches, only after its run.py exits successfully. The
+    message of a failed job becomes visible again and is retried, until it
+    has been received MaxReceives times.
+    """
+    def __init__(self):
+        self.visibility_timeout = int(config['annotator']['VisibilityTimeout'])
+        self.heartbeat_seconds = int(config['annotator']['HeartbeatSeconds'])
+        self.max_receives = int(config['annotator']['MaxReceives'])
+        self.in_progress = set()
+        self.to_delete = []
+
+    def hold(self, receipt_handle: str):
+        self.in_progress.add(receipt_handle)
+
+    def done(self, receipt_handle: str, succeeded: bool):
+        self.in_progress.discard(receipt_handle)
+        if succeeded:
+            self.to_delete.append(receipt_handle)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_seconds)
+            handles = list(self.in_progress)
+            for i in range(0, len(handles), SQS_BATCH):
+                try:
+                    await asyncio.to_thread(sqs.change_message_visibility_batch,
+                        QueueUrl=sqs_url,
+                        Entries=sqs_entries(handles[i:i + SQS_BATCH],
+                            VisibilityTimeout=self.visibility_timeout))
+                except ClientError as e:
+                    print(f"Error extending visibility of annotation job requests: {e}")
+
+    async def delete_finished(self):
+        while True:
+            await asyncio.sleep(1)
+            while (len(self.to_delete) > 0):
+                handles = self.to_delete[:SQS_BATCH]
+                del self.to_delete[:SQS_BATCH]
+                try:
+                    response = await asyncio.to_thread(sqs.delete_message_batch,
+                        QueueUrl=sqs_url, Entries=sqs_entries(handles))
+                    for failed in response.get('Failed', []):
+                        print(f"Error deleting SQS message upon successful annotation: {failed.get('Message')}")
+                except ClientError as e:
+                    print(f"Error deleting SQS message upon successful annotation: {e}")
+
+def set_running(job_id: str):
+    """
+    Updates a job in DynamoDB to RUNNING only if currently PENDING, or
+    already RUNNING when its request is redelivered after a failed attempt
+    """
+    # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
+    dynamo_table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression="SET #attr1 = :new_status",
+        ConditionExpression="job_status IN (:pending, :running)",
+        ExpressionAttributeNames={'#attr1': 'job_status'},
+        ExpressionAttributeValues={':new_status': 'RUNNING', ':pending': 'PENDING', ':running': 'RUNNING'}
+    )
+
+def set_failed(job_id: str, reason: str):
+    """
+    Updates a job in DynamoDB to FAILED only if it is PENDING or RUNNING
+    """
+    dynamo_table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression="SET #attr1 = :new_status, #attr2 = :reason",
+        ConditionExpression="job_status IN (:pending, :running)",
+        ExpressionAttributeNames={'#attr1': 'job_status', '#attr2': 'failure_reason'},
+        ExpressionAttributeValues={':new_status': 'FAILED', ':reason': reason,
+            ':pending': 'PENDING', ':running': 'RUNNING'}
+    )
+
+async def handle_message(message: dict, executor: JobExecutor, messages: QueueMessages):
+    """
+    Runs one annotation job: downloads its input, launches run.py and
+    waits for it to exit. A request received more than MaxReceives times
+    is not run again: its job is marked FAILED and the request deleted.
+    """
+    receives = int(message.get("Attributes", {}).get("ApproximateReceiveCount", 1))
+    if (receives > messages.max_receives):
+        await give_up(message, receives - 1)
+        messages.done(message["ReceiptHandle"], True)
+        return
+    messages.hold(message["ReceiptHandle"])
+    returncode = None
+    try:
+        returncode = await process_job(message, executor)
+    finally:
+        messages.done(message["ReceiptHandle"], returncode == 0)
+
+async def give_up(message: dict, attempts: int):
+    """
+    Marks the job of a request that keeps failing FAILED
+    """
+    try:
+        job_id = parse_message(message)["job_id"]
+    except (KeyError, ValueError) as e:
+        print(f"Error decoding message of annotation job to give up on: {e}")
+        return
+    print(f"Annotation job {job_id} failed {attempts} times, giving up on it")
+    try:
+        await asyncio.to_thread(set_failed, job_id, f"Annotation failed {attempts} times")
+    except Exception as msg:
+        print(f"Oops, could not update DynamoDB for annotation job results on job {job_id}: {str(msg)}")
+
+async def process_job(message: dict, executor: JobExecutor):
+    """
+    Returns the exit status of run.py, or None if it was not started
+    """
+    try:
+        job = parse_message(message)
+    except KeyError as e:
+        print(f"Error decoding message to kick off annotation job: {e}")
+        return
+    job_id = job["job_id"]
+
+    if config.getboolean('annotation', 'StreamS3'):
+        # run.py reads the input straight from S3
+        input_path = f"s3://{job['s3_bucket']}/{job['s3_key']}"
+    else:
+        # download S3 file into current EC2 instance
+        try:
+            input_path = await asyncio.to_thread(download_input, job)
+        except ClientError as e:
+            print(f"Error downloading S3 file for {job_id} to run annotation on: {e}")
+            return
+
+    # marked RUNNING first: a warm worker can finish a small job, and
+    # expect it to be RUNNING, before an update made after launch
+    try:
+        await asyncio.to_thread(set_running, job_id)
+    except Exception as msg:
+        print(f"Oops, could not update DynamoDB for annotation job results on job {job_id}: {str(msg)}")
+
+    try:
+        await executor.launch(input_path, job)
+        print(f"Annotation job started for {job_id}")
+    except Exception as e:
+        print(f"Error when running annotation for {job_id}: {e}")
+        return
+    return await executor.wait(job_id)
+
+async def poll():
+    """
+    Long polls the job requests queue whenever the executor has a free
+    slot, handing every message to its own task
+    """
+    executor = JobExecutor(max_jobs, warm=config.getboolean('annotator', 'WarmWorkers'))
+    messages = QueueMessages()
+    background = [asyncio.create_task(messages.heartbeat()),
+        asyncio.create_task(messages.delete_finished())]
+    print(f"Running up to {max_jobs} annotation jobs at once")
     while True:
+        reserved = await executor.reserve(SQS_BATCH)
         print("Polling for new annotation job requests...")
 
-        # Long poll for message on provided SQS queue
-        response = sqs.receive_message(
-            QueueUrl=sqs_url,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=5
-        )
-
-        # a message was found
-        if 'Messages' in response:
-            request_body = response["Messages"][0]
-            payload = json.loads(request_body["Body"])
-            message_body = json.loads(payload.get("Message"))
-
-            # extract values from received message
-            try: 
-                job_id = message_body["job_id"]
-                input_file_name = message_body["input_file_name"]
-                s3_bucket = message_body["s3_inputs_bucket"]
-                s3_key = message_body["s3_key_input_file"]
-                user_id = message_body["user_id"]
-                user_email = message_body["user_email"]
-                message_id = payload["MessageId"]
-            except KeyError as e:
-                print(f"Error decoding message to kick off annotation job: {e}")
-                continue 
-
-            # make a new sub-directory for this job so can persist unique outfiles
-            new_job_directory = config['annotation_output']['OutputFolder'] + '/' + job_id
-            make_new_directory(new_job_directory)
-            downloaded_file_path = new_job_directory + "/" + input_file_name
-
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-            # download S3 file into current EC2 instance, write it to a file in a folder unique to its job id
-            try: 
-                with open(downloaded_file_path, 'wb') as f:
-                    s3_client.download_fileobj(s3_bucket, s3_key, f)
-            except ClientError as e:
-                print(f"Error downloading S3 file for {job_id} to run annotation on: {e}")
-                continue
+        # Long poll for as many messages as there are free slots
+        try:
+            response = await asyncio.to_thread(sqs.receive_message,
+                QueueUrl=sqs_url,
+                MaxNumberOfMessages=reserved,
+                WaitTimeSeconds=5,
+                VisibilityTimeout=messages.visibility_timeout,
+                AttributeNames=['ApproximateReceiveCount']
+            )
+        except ClientError as e:
+            print(f"Error receiving annotation job requests: {e}")
+            executor.release(reserved)
+            await asyncio.sleep(5)
+            continue
 
-            # execute run.py subprocess for this job
-            submit_command = ['python', 'run.py', downloaded_file_path, "--parameter1", job_id, "--parameter2", input_file_name, "--parameter3", user_id, "--parameter4", user_email]
-            try:
-                # check the run.py file exists
-                with open("run.py", 'r') as file:
-                    # Process the file as needed
-                    file_contents = file.read()
-                process = subprocess.Popen(submit_command)
-                print(f"Annotation job started for {job_id}")
-            except FileNotFoundError:
-                print(f"Error when running annotation for {job_id}: {e}")
-                continue
-            # Check if the subprocess is still running or if it encountered an error finding the file
-            except Exception as e:
-                print(f"Error when running annotation for {job_id}: {e}")
-                continue
-
-            # submitting annotation job was successful, so delete message from the queue since already processed
-            try: 
-                response = sqs.delete_message(
-                    QueueUrl=sqs_url,
-                    ReceiptHandle=request_body['ReceiptHandle']
-                )
-            except ClientError as e:
-                print(f"Error deleting SQS message upon successful annotation: {e}")
-                continue
-        
-            # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
-            # update job in DynamoDB to RUNNING only if currently PENDING
-            try:
-                response = dynamo_table.update_item(
-                    Key={'job_id': job_id},
-                    UpdateExpression="SET #attr1 = :new_status",
-                    ConditionExpression="job_status = :expected_status",
-                    ExpressionAttributeNames={'#attr1': 'job_status'},
-                    ExpressionAttributeValues={':new_status': 'RUNNING', ':expected_status': 'PENDING'}
-                )
-            except Exception as msg:
-                print(f"Oops, could not update DynamoDB for annotation job results on job {job_id}: {str(msg)}")
\ No newline at end of file
+        received = response.get('Messages', [])
+        executor.release(reserved - len(received))
+        for message in received:
+            executor.submit(handle_message(message, executor, messages))
+
+if __name__ == '__main__':
+    asyncio.run(poll())
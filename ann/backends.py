@@ -0,0 +1,168 @@
+# backends.py
+#
+# Databases the annotators can read the reference tables from
+#
+# A backend opens connections and wraps them in queries.Queries with the
+# parameter style of its driver. MySQLBackend is the RDS annotator
+# database (through the utils connection pool); SQLiteBackend reads a
+# local SQLite replica of the annotator schema; MemoryBackend holds the
+# tables in an in-memory SQLite database, for tests and benchmarks.
+#
+##
+
+import os
+import sqlite3
+
+import pymysql
+
+import queries
+import utils as u
+
+"""Indexes a replica needs for the annotator statements
+   table name -> list of indexed column tuples; the tfbsConsSites<chrom>
+   tables are indexed by create_indexes() as they are found.
+"""
+INDEXES = {
+    'dbSNP': [('CHR', 'POS')],
+    'chrom_pos_equal_base': [('CHR', 'start')],
+    'chrom_pos_equal_nobase': [('CHR', 'start')],
+    'chrom_pos_unequal': [('CHR', 'start')],
+    'refGene': [('chrom', 'txStart')],
+    'cpgIslandExt': [('chrom', 'chromStart')],
+    'cytoBand': [('chrom', 'chromStart')],
+    'gadAll': [('chromosome', 'chromStart')],
+    'gwasCatalog': [('chrom', 'chromEnd')],
+    'targetScanS': [('chrom', 'chromStart')],
+    'hugo': [('chrom', 'chromStart')],
+    'dgv_Cnv': [('chrom', 'chromStart')],
+    'abParts_IG_T_CelReceptors': [('chrom', 'chromStart')],
+    'mcCarroll_Cnv': [('chrom', 'chromStart')],
+    'conrad_Cnv': [('chrom', 'chromStart')],
+    'genomicSuperDups': [('chrom', 'chromStart')],
+}
+
+
+"""Base class of the backends
+   forks - False if the backend cannot be handed to worker processes
+"""
+class Backend(object):
+    name = None
+    paramstyle = 'format'
+    forks = True
+
+    """New DB-API connection; close() it when done
+    """
+    def connect(self):
+        raise NotImplementedError
+
+    """queries.Queries over conn, in this backend's parameter style
+       stream - read results row by row instead of buffering them
+    """
+    def queries(self, conn, stream=False):
+        return queries.Queries(conn, paramstyle=self.paramstyle,
+            cursor=self.stream_cursor(conn) if stream else None)
+
+    def stream_cursor(self, conn):
+        return conn.cursor()
+
+
+"""The annotator database on RDS
+"""
+class MySQLBackend(Backend):
+    name = 'mysql'
+
+    def connect(self):
+        return u.db_connect()
+
+    def stream_cursor(self, conn):
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+
+"""A local SQLite replica of the annotator database, opened read-only
+"""
+class SQLiteBackend(Backend):
+    name = 'sqlite'
+    paramstyle = 'qmark'
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"No SQLite replica at {self.path}")
+        return sqlite3.connect('file:' + self.path + '?mode=ro', uri=True,
+            check_same_thread=False)
+
+
+"""Connection that stays open when the pipeline closes it
+"""
+class _SharedConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        pass
+
+
+"""The reference tables in an in-memory SQLite database
+   source - optional SQLite file copied in on creation. Every connect()
+   returns the same database, so it is not shared with forked workers.
+"""
+class MemoryBackend(Backend):
+    name = 'memory'
+    paramstyle = 'qmark'
+    forks = False
+
+    def __init__(self, source=None):
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        if source is not None:
+            src = sqlite3.connect(source)
+            src.backup(self.conn)
+            src.close()
+
+    def connect(self):
+        return _SharedConnection(self.conn)
+
+    """Creates table (if needed) and inserts rows
+    """
+    def load(self, table, columns, rows):
+        self.conn.execute('create table if not exists ' + table + ' (' + \
+            ', '.join(columns) + ')')
+        self.conn.executemany('insert into ' + table + ' values (' + \
+            ','.join(['?'] * len(columns)) + ')', rows)
+        self.conn.commit()
+
+
+"""Creates the INDEXES of every reference table found in a SQLite
+   connection
+"""
+def create_indexes(conn):
+    tables = [row[0] for row in conn.execute(
+        "select name from sqlite_master where type='table'")]
+    for table in tables:
+        columns = INDEXES.get(table)
+        if (columns is None) and table.startswith('tfbsConsSites'):
+            columns = [('chromStart',)]
+        for cols in (columns or []):
+            conn.execute('create index if not exists ' + table + '_' + \
+                '_'.join(cols) + ' on ' + table + ' (' + ', '.join(cols) + ')')
+    conn.commit()
+
+
+"""Backend selected by name: mysql, sqlite (path is the replica file) or
+   memory (path, if given, is copied in)
+"""
+def open_backend(name='mysql', path=None):
+    name = (name or 'mysql').lower()
+    if (name == 'mysql'):
+        return MySQLBackend()
+    if (name == 'sqlite'):
+        return SQLiteBackend(path)
+    if (name == 'memory'):
+        return MemoryBackend(source=path or None)
+    raise ValueError(f"Unknown annotation backend: {name}")
+
+### EOF
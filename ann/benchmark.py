@@ -0,0 +1,289 @@
+# benchmark.py
+#
+# End-to-end annotation benchmark over the ann/data fixtures
+#
+# fixture-db extracts, from the annotator database (or a SQLite replica),
+# the rows of every reference table that the fixture VCFs can hit into a
+# small SQLite database. run annotates each fixture with driver.run
+# against that database and reports variants/sec and the time of every
+# stage (see driver.job_stats); the results are saved, with the commit
+# they were measured on, as JSON. compare prints the change between two
+# saved results.
+#
+# Usage:
+#   python benchmark.py fixture-db <db_path> [--sqlite SRC] [fixture ...]
+#   python benchmark.py run <db_path> [--memory] [--repeat N] [--out FILE]
+#       [--index-dir DIR] [--sweep] [--batch-overlap] [--nclist]
+#       [--batch-size N] [--warm-cache] [fixture ...]
+#   python benchmark.py compare <old.json> <new.json>
+#
+##
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import backends
+import driver
+import file_utils as fu
+import interval_index as ii
+import lookup_cache
+import pipeline
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+"""Columns (chrom, start, end) the rows of a table are selected on
+   The tfbsConsSites<chrom> tables are added for the fixture chromosomes.
+"""
+FIXTURE_TABLES = dict(ii.TRACKS)
+FIXTURE_TABLES.update({
+    'dbSNP': ('CHR', 'POS', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start', 'end'),
+    'chrom_pos_equal_nobase': ('CHR', 'start', 'end'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+})
+
+# Margin around the fixture positions; covers the refGene promoter offset
+PADDING = 1000
+# Positions closer than this are selected with one query
+WINDOW_GAP = 10000
+
+
+def fixture_files(names=None):
+    if names:
+        return names
+    return sorted(glob.glob(os.path.join(DATA_DIR, '*.vcf')))
+
+
+"""Windows (lo, hi) around the positions of the fixtures, by chromosome
+   (without the "chr" prefix)
+"""
+def fixture_windows(fixtures):
+    positions = {}
+    for path in fixtures:
+        with fu.open_vcf(path) as fh:
+            for batch in pipeline.read_batches(fh):
+                for record in pipeline.records_of(batch):
+                    positions.setdefault(record.chrom, set()).add(record.pos)
+
+    windows = {}
+    for chrom, found in positions.items():
+        merged = []
+        for pos in sorted(found):
+            if (len(merged) > 0) and (pos - merged[-1][1] <= WINDOW_GAP):
+                merged[-1][1] = pos
+            else:
+                merged.append([pos, pos])
+        windows[chrom] = [(lo - PADDING, hi + PADDING) for (lo, hi) in merged]
+    return windows
+
+
+"""Rows of table overlapping any of the windows, and its column names
+   Chromosomes are looked up with and without the "chr" prefix, since
+   the tables differ. Rows are kept in the order the source returns
+   them. Returns (None, None) if the table does not exist.
+"""
+def extract_table(db, table, columns, windows):
+    (chrom_col, start_col, end_col) = columns
+    names = None
+    rows = {}
+    for chrom, spans in windows.items():
+        for name in (chrom, 'chr' + chrom):
+            for (lo, hi) in spans:
+                try:
+                    cursor = db.execute('overlap', [name, hi, lo], table=table,
+                        chrom=chrom_col, start=start_col, end=end_col)
+                except Exception as e:
+                    print(f"{table}: skipped ({e})")
+                    return (None, None)
+                names = [d[0] for d in cursor.description]
+                for row in cursor.fetchall():
+                    rows[tuple(row)] = None
+    return (names, list(rows))
+
+
+"""Builds the fixture database at db_path from backend (MySQL by default)
+"""
+def build_fixture_db(db_path, fixtures=None, backend=None):
+    backend = backend or backends.MySQLBackend()
+    windows = fixture_windows(fixture_files(fixtures))
+    tables = dict(FIXTURE_TABLES)
+    for chrom in windows:
+        tables['tfbsConsSites' + chrom] = ('chrom', 'chromStart', 'chromEnd')
+
+    tmp = db_path + '.tmp'
+    if os.path.isfile(tmp):
+        os.unlink(tmp)
+    out = sqlite3.connect(tmp)
+    conn = backend.connect()
+    try:
+        db = backend.queries(conn)
+        for table in sorted(tables):
+            (names, rows) = extract_table(db, table, tables[table], windows)
+            if names is None:
+                continue
+            out.execute('create table ' + table + ' (' + ', '.join(names) + ')')
+            out.executemany('insert into ' + table + ' values (' + \
+                ','.join(['?'] * len(names)) + ')', rows)
+            print(f"{table}: {len(rows)} rows")
+    finally:
+        conn.close()
+    out.commit()
+    backends.create_indexes(out)
+    out.close()
+    os.replace(tmp, db_path)
+
+
+def current_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=DATA_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'],
+            cwd=DATA_DIR, stderr=subprocess.DEVNULL) != 0
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+"""Annotates one fixture repeat times; returns the job statistics of the
+   fastest run
+   warm_cache - keep the lookup cache (and gene models) between runs
+   instead of clearing them
+"""
+def run_fixture(path, backend, options, repeat=3, warm_cache=False):
+    best = None
+    with tempfile.TemporaryDirectory() as tmp:
+        infile = os.path.join(tmp, os.path.basename(path))
+        shutil.copy(path, infile)
+        for i in range(repeat):
+            if not warm_cache:
+                lookup_cache.clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = driver.run(infile, 'vcf', backend=backend, **options)
+            if (best is None) or (stats['seconds'] < best['seconds']):
+                best = stats
+    return best
+
+
+"""Runs the benchmark over fixtures; returns the results
+"""
+def run(db_path, fixtures=None, memory=False, repeat=3, warm_cache=False,
+    **options):
+    backend = backends.MemoryBackend(source=db_path) if memory else \
+        backends.SQLiteBackend(db_path)
+    results = {'commit': current_commit(), 'created': int(time.time()),
+        'backend': backend.name, 'repeat': repeat, 'warm_cache': warm_cache,
+        'options': options, 'fixtures': {}}
+    for path in fixture_files(fixtures):
+        name = os.path.basename(path)
+        stats = run_fixture(path, backend, options, repeat=repeat,
+            warm_cache=warm_cache)
+        results['fixtures'][name] = stats
+        print(f"{name}: {stats['variants']} variants in " + \
+            f"{stats['seconds']:.3f} seconds, " + \
+            f"{stats['variants_per_second']} variants/sec")
+    return results
+
+
+"""Wall time of every stage, summed over the fixtures of results
+"""
+def stage_times(results):
+    times = {}
+    for stats in results['fixtures'].values():
+        for stage in stats['stages']:
+            times[stage['stage']] = times.get(stage['stage'], 0) + stage['wall_s']
+    return times
+
+
+def change(old, new):
+    if not old:
+        return ''
+    return f"{100.0 * (new - old) / old:+.1f}%"
+
+
+"""Prints the change in throughput per fixture and in time per stage
+"""
+def compare(old, new):
+    print(f"{old['commit']} -> {new['commit']}")
+    for name, stats in new['fixtures'].items():
+        before = old['fixtures'].get(name)
+        if before is None:
+            continue
+        print(f"{name}: {before['variants_per_second']} -> " + \
+            f"{stats['variants_per_second']} variants/sec " + \
+            change(before['variants_per_second'], stats['variants_per_second']))
+
+    old_times = stage_times(old)
+    for stage, seconds in stage_times(new).items():
+        if stage in old_times:
+            print(f"{stage}: {old_times[stage]:.3f}s -> {seconds:.3f}s " + \
+                change(old_times[stage], seconds))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('fixture-db')
+    p.add_argument('db_path')
+    p.add_argument('fixtures', nargs='*')
+    p.add_argument('--sqlite', help='extract from a SQLite replica instead of MySQL')
+
+    p = commands.add_parser('run')
+    p.add_argument('db_path')
+    p.add_argument('fixtures', nargs='*')
+    p.add_argument('--memory', action='store_true',
+        help='load the fixture database into memory')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--out', help='results file, bench-<commit>.json by default')
+    p.add_argument('--index-dir')
+    p.add_argument('--sweep', action='store_true')
+    p.add_argument('--batch-overlap', action='store_true')
+    p.add_argument('--nclist', action='store_true')
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.add_argument('--warm-cache', action='store_true')
+
+    p = commands.add_parser('compare')
+    p.add_argument('old')
+    p.add_argument('new')
+
+    args = parser.parse_args(argv)
+    if (args.command == 'fixture-db'):
+        backend = backends.SQLiteBackend(args.sqlite) if args.sqlite else None
+        build_fixture_db(args.db_path, fixtures=args.fixtures or None,
+            backend=backend)
+    elif (args.command == 'run'):
+        results = run(args.db_path, fixtures=args.fixtures or None,
+            memory=args.memory, repeat=args.repeat,
+            warm_cache=args.warm_cache, index_dir=args.index_dir,
+            sweep=args.sweep, batch_overlap=args.batch_overlap,
+            nclist=args.nclist, batch_size=args.batch_size)
+        out = args.out or f"bench-{results['commit']}.json"
+        with open(out, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f"Results written to {out}")
+    elif (args.command == 'compare'):
+        with open(args.old) as fh:
+            old = json.load(fh)
+        with open(args.new) as fh:
+            new = json.load(fh)
+        compare(old, new)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+### EOF
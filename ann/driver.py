@@ -10,112 +10,231 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import json
 import sys
 import os
-import file_utils as fu
+import time
 import annotate as ann
-
-def run(infile, format):
-
+import backends
+import file_utils as fu
+import interval_index as ii
+import lookup_cache
+import overlap_batch
+import pipeline
+import s3_stream
+
+# Interval indexes opened in this process, by directory; a process that
+# runs several jobs keeps their chromosomes mapped between jobs
+_indexes = {}
+
+def open_indexes(index_dir):
+    if index_dir not in _indexes:
+        _indexes[index_dir] = ii.open_indexes(index_dir)
+    return _indexes[index_dir]
+
+
+"""Annotation stages, in the order they are applied
+   index_dir - optional directory of interval indexes (see interval_index.py);
+   tables found there are searched locally instead of queried in MySQL
+   sweep - join the overlap stages against position-sorted input in one
+   scan per chromosome (see sweep.py)
+   batch_overlap - resolve the overlap stages for a whole batch of records
+   at once with numpy (see overlap_batch.py)
+   nclist - hold the intervals of the overlap stages in memory as nested
+   containment lists (see nclist.py)
+"""
+def annotators(index_dir=None, sweep=False, batch_overlap=False,
+    nclist=False):
+    indexes = open_indexes(index_dir) if index_dir else {}
+    stages = [
+        ann.DbSnpAnnotator(),
+        ann.BigRefGeneAnnotator(),
+        ann.GenesAnnotator(table='refGene', promoter_offset=500),
+        ann.CytobandAnnotator(table='cytoBand', index=indexes.get('cytoBand')),
+        ann.GadAllAnnotator(table='gadAll', index=indexes.get('gadAll')),
+        ann.GwasCatalogAnnotator(table='gwasCatalog'),
+        ann.MiRNAAnnotator(table='targetScanS', 
+            index=indexes.get('targetScanS')),
+        ann.HugoAnnotator(table='hugo', index=indexes.get('hugo')),
+        ann.CnvAnnotator(table='dgv_Cnv', index=indexes.get('dgv_Cnv')),
+        ann.CnvAnnotator(table='abParts_IG_T_CelReceptors', 
+            index=indexes.get('abParts_IG_T_CelReceptors')),
+        ann.CnvAnnotator(table='mcCarroll_Cnv', 
+            index=indexes.get('mcCarroll_Cnv')),
+        ann.CnvAnnotator(table='conrad_Cnv', index=indexes.get('conrad_Cnv')),
+        ann.GenomicSuperDupsAnnotator(table='genomicSuperDups', 
+            index=indexes.get('genomicSuperDups')),
+        ann.TfbsConsSitesAnnotator(table='tfbsConsSites'),
+    ]
+    if batch_overlap and not overlap_batch.available():
+        print("numpy is not installed, overlap stages use per-variant lookups")
+    for stage in stages:
+        if isinstance(stage, ann.OverlapAnnotator):
+            if sweep:
+                stage.enable_sweep()
+            if batch_overlap:
+                stage.enable_batch()
+            if nclist:
+                stage.enable_nclist()
+    return stages
+
+
+"""Job statistics for the .stats.json sidecar
+   stats - the pipeline.StageStats of every stage
+   cache - lookup cache stats, for jobs annotated in this process
+   store - variant store stats of the job, if it used one
+"""
+def job_stats(stats, count, seconds, workers=1, cache=None, store=None):
+    return {'variants': count, 'seconds': round(seconds, 3),
+        'variants_per_second': round(count / seconds, 1) if seconds else None,
+        'workers': workers, 'lookup_cache': cache, 'variant_store': store,
+        'stages': [stage.summary() for stage in stats]}
+
+
+def print_stats(summary):
+    for stage in summary['stages']:
+        print(f"{stage['stage']}: {stage['wall_s']:.2f}s wall, " + \
+            f"{stage['cpu_s']:.2f}s cpu, {stage['queries']} queries, " + \
+            f"{stage['rows']} rows")
+    cache = summary['lookup_cache']
+    if cache is not None:
+        print(f"Lookup cache: {cache['hits']} hits, {cache['misses']} " + \
+            f"misses, {cache['entries']} entries")
+    store = summary.get('variant_store')
+    if store is not None:
+        print(f"Variant store: {store['hits']} hits, {store['misses']} " + \
+            f"misses, {store['stored']} stored")
+
+
+"""Runs the annotation stages over infile in a single pass
+   Writes <name>.annot.vcf, the stage counts to <name>.vcf.count.log and
+   the job statistics (see job_stats) to <name>.vcf.stats.json; infile
+   may be <name>.vcf or a gzip/BGZF compressed <name>.vcf.gz
+   See annotators() for index_dir, sweep, batch_overlap and nclist.
+   backend - backends.Backend the reference tables are read from, MySQL
+   by default; one that cannot fork runs with a single worker
+   workers - with more than 1, the input is split by chromosome and the
+   shards are annotated in parallel;
+   workers=0 uses one worker per CPU.
+   reference_version - version of the reference data; lookups and gene
+   models cached by earlier jobs in this process are dropped when it
+   changes
+   variant_store - variant_store.VariantStore the annotations of variants
+   seen by earlier jobs are taken from, and new ones added to; its
+   entries are kept per reference_version, and it is brought back under
+   its cap at the end of the job
+   max_input_bytes - largest input annotated, once decompressed; a larger
+   one raises fu.InputTooLarge before anything is annotated
+   Returns the job statistics.
+"""
+def run(infile, format, index_dir=None, batch_size=1000, sweep=False,
+    workers=1, reference_version=None, batch_overlap=False, nclist=False,
+    backend=None, variant_store=None, max_input_bytes=None):
+
+    if max_input_bytes is not None:
+        fu.check_size(infile, max_input_bytes)
     print("Running . . .")
+    start = time.time()
+    lookup_cache.set_version(reference_version)
+    store_start = None
+    if variant_store is not None:
+        variant_store.set_version(reference_version)
+        store_start = variant_store.stats()
+    base = fu.uncompressed_name(infile)
+    finalout = (base + '.annot').replace('.vcf.annot', '.annot.vcf')
+    logfile = base + '.count.log'
+    args = {'index_dir': index_dir, 'sweep': sweep,
+        'batch_overlap': batch_overlap, 'nclist': nclist}
+
+    backend = backend or backends.MySQLBackend()
+    if (workers == 0):
+        workers = os.cpu_count() or 1
+    if (workers > 1) and not backend.forks:
+        print(f"The {backend.name} backend runs with a single worker")
+        workers = 1
+    cache = None
+    if (workers > 1):
+        stats = pipeline.stage_stats(annotators(**args))
+        count = pipeline.run_parallel(annotators, infile, finalout, logfile,
+            workers=workers, format=format, batch_size=batch_size,
+            annotator_args=args, backend=backend, stats=stats,
+            store=variant_store)
+    else:
+        stages = annotators(**args)
+        stats = pipeline.stage_stats(stages)
+        count = pipeline.run(stages, infile, finalout, logfile,
+            format=format, batch_size=batch_size, backend=backend,
+            stats=stats, store=variant_store)
+        cache = lookup_cache.CACHE.stats()
+
+    store_stats = None
+    if variant_store is not None:
+        variant_store.enforce_cap()
+        store_stats = variant_store.stats(since=store_start)
+    summary = job_stats(stats, count, time.time() - start, workers, cache,
+        store_stats)
+    with open(base + '.stats.json', 'w') as fh:
+        json.dump(summary, fh, indent=2)
+    print_stats(summary)
+    print(f"Annotated {count} variants - done.")
+    return summary
+
+
+"""Annotates an S3 object straight into another, without local files
+   The input (plain or gzip/BGZF) is read from the response body as it
+   arrives and the output is sent as a multipart upload while it is
+   written; the counts are stored at log_url and the job statistics at
+   stats_url, if given. Runs in a single process; the other arguments
+   are as for run(), except that an input over max_input_bytes raises
+   fu.InputTooLarge as soon as that much of it has been read (the output
+   upload is then aborted). input_sha, if given, is a hashlib object
+   updated with the input's bytes as they are read (see
+   s3_stream.open_input). Returns the job statistics.
+"""
+def run_s3(s3_client, input_url, output_url, log_url, format='vcf',
+    index_dir=None, batch_size=1000, sweep=False, reference_version=None,
+    batch_overlap=False, nclist=False, backend=None, stats_url=None,
+    variant_store=None, max_input_bytes=None, input_sha=None):
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
-
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
-
-### EOF
\ No newline at end of file
+    print("Running . . .")
+    start = time.time()
+    lookup_cache.set_version(reference_version)
+    store_start = None
+    if variant_store is not None:
+        variant_store.set_version(reference_version)
+        store_start = variant_store.stats()
+    stages = annotators(index_dir=index_dir, sweep=sweep,
+        batch_overlap=batch_overlap, nclist=nclist)
+    stats = pipeline.stage_stats(stages)
+
+    (bucket, key) = s3_stream.parse_url(input_url)
+    (out_bucket, out_key) = s3_stream.parse_url(output_url)
+    with s3_stream.open_input(s3_client, bucket, key, sha=input_sha) as fh, \
+        s3_stream.MultipartWriter(s3_client, out_bucket, out_key) as fh_out:
+        if max_input_bytes is not None:
+            fh = fu.limit_size(fh, max_input_bytes)
+        count = pipeline.run_stream(stages, fh, fh_out, format=format,
+            batch_size=batch_size, backend=backend, stats=stats,
+            store=variant_store)
+
+    (log_bucket, log_key) = s3_stream.parse_url(log_url)
+    s3_client.put_object(Bucket=log_bucket, Key=log_key,
+        Body=pipeline.log_text(stages).encode('utf-8'),
+        ContentType='text/plain')
+
+    store_stats = None
+    if variant_store is not None:
+        variant_store.enforce_cap()
+        store_stats = variant_store.stats(since=store_start)
+    summary = job_stats(stats, count, time.time() - start,
+        cache=lookup_cache.CACHE.stats(), store=store_stats)
+    if stats_url is not None:
+        (stats_bucket, stats_key) = s3_stream.parse_url(stats_url)
+        s3_client.put_object(Bucket=stats_bucket, Key=stats_key,
+            Body=json.dumps(summary, indent=2).encode('utf-8'),
+            ContentType='application/json')
+    print_stats(summary)
+    print(f"Annotated {count} variants - done.")
+    return summary
+
+### EOF
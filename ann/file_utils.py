@@ -11,6 +11,7 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os.path
+import gzip
 import linecache
 import csv
 import os
@@ -91,6 +92,62 @@ def delete(filename):
         os.unlink(filename)
 
 
+"""True if filename is gzip (or BGZF) compressed, by its magic bytes
+"""
+def is_gzip(filename):
+    with open(filename, 'rb') as fh:
+        return (fh.read(2) == b'\x1f\x8b')
+
+
+"""Opens a VCF (or pileup) for reading as text
+   gzip input, including BGZF (a series of gzip members), is recognised
+   by its magic bytes and decompressed as it is read.
+"""
+def open_vcf(filename):
+    if is_gzip(filename):
+        return gzip.open(filename, 'rt')
+    return open(filename)
+
+
+"""Raised when an input is over the size its job may annotate
+"""
+class InputTooLarge(ValueError):
+    pass
+
+
+"""Raises InputTooLarge if a VCF is over max_bytes once decompressed
+   Reading stops as soon as it is past max_bytes.
+"""
+def check_size(filename, max_bytes):
+    opener = gzip.open if is_gzip(filename) else open
+    size = 0
+    with opener(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(64 * 1024), b''):
+            size = size + len(block)
+            if (size > max_bytes):
+                raise InputTooLarge(f"Input is over {max_bytes} bytes uncompressed")
+
+
+"""Lines of the text stream fh; raises InputTooLarge once more than
+   max_bytes have been read
+"""
+def limit_size(fh, max_bytes):
+    size = 0
+    for line in fh:
+        size = size + len(line.encode('utf-8'))
+        if (size > max_bytes):
+            raise InputTooLarge(f"Input is over {max_bytes} bytes uncompressed")
+        yield line
+
+
+"""Name of a VCF without its .gz suffix, if any
+"""
+def uncompressed_name(filename):
+    if filename.endswith('.gz'):
+        return filename[:-3]
+    return filename
+
+
 """Makes directory if it does not exist
 """
 def mkdirp(directory):
@@ -0,0 +1,318 @@
+# interval_index.py
+#
+# Memory-mapped interval index for the overlap reference tables
+#
+# Each indexed table is a directory holding a manifest and one file per
+# chromosome. A chromosome file stores the intervals sorted by start as
+# int64 arrays (starts, ends, running max of ends, row offsets) followed
+# by the pickled table rows, so lookups are a bisection over the mapped
+# arrays and only matching rows are unpickled. Tables built with
+# kind='nclist' store each chromosome as an nclist.NCList instead, for
+# tracks with deeply nested intervals.
+#
+##
+
+import bisect
+import json
+import mmap
+import os
+import pickle
+import sys
+import time
+from array import array
+
+import backends
+import nclist
+import utils as u
+
+MAGIC = b'ANNIDX01'
+MANIFEST = 'manifest.json'
+
+"""Reference tables served by the index:
+   table name -> (chromosome column, start column, end column)
+"""
+TRACKS = {
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+}
+
+
+"""Sort key of a table row among rows with the same start and end
+"""
+def row_key(row):
+    return tuple(str(v) for v in row)
+
+
+"""(start, end, row) triples in the order every overlap mode returns rows:
+   by start, then end, then row_key, so which row a stage picks does not
+   depend on the order the database stores them in
+"""
+def in_row_order(triples):
+    triples = sorted(triples, key=lambda t: (int(t[0]), int(t[1])))
+    i = 0
+    while (i < len(triples)):
+        j = i + 1
+        while (j < len(triples)) and \
+            (int(triples[j][0]) == int(triples[i][0])) and \
+            (int(triples[j][1]) == int(triples[i][1])):
+            j = j + 1
+        if (j - i > 1):
+            triples[i:j] = sorted(triples[i:j], key=lambda t: row_key(t[2]))
+        i = j
+    return triples
+
+
+"""Intervals of one chromosome, sorted by start
+   A position overlaps interval i when starts[i] <= pos <= ends[i].
+   maxends[i] is the largest end among intervals 0..i, which is
+   non-decreasing and so bounds the left edge of the search.
+"""
+class Intervals(object):
+    def __init__(self, starts, ends, maxends, rows):
+        self.starts = starts
+        self.ends = ends
+        self.maxends = maxends
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Builds the arrays in memory from (start, end, row) triples
+       The sort is stable: triples in in_row_order keep that order.
+    """
+    @classmethod
+    def from_rows(cls, triples):
+        triples = sorted(triples, key=lambda t: (t[0], t[1]))
+        starts = array('q')
+        ends = array('q')
+        maxends = array('q')
+        rows = []
+        maxend = None
+        for (start, end, row) in triples:
+            starts.append(int(start))
+            ends.append(int(end))
+            maxend = int(end) if maxend is None else max(maxend, int(end))
+            maxends.append(maxend)
+            rows.append(row)
+        return cls(starts, ends, maxends, rows)
+
+    """Index range [lo, hi) that can contain intervals overlapping pos
+    """
+    def candidates(self, pos):
+        hi = bisect.bisect_right(self.starts, pos)
+        lo = bisect.bisect_left(self.maxends, pos, 0, hi)
+        return (lo, hi)
+
+    """All rows overlapping pos (fetchall semantics)
+    """
+    def overlapping(self, pos):
+        (lo, hi) = self.candidates(pos)
+        ends = self.ends
+        return [self.rows[i] for i in range(lo, hi) if ends[i] >= pos]
+
+    """First row overlapping pos, or None (fetchone semantics)
+    """
+    def first(self, pos):
+        (lo, hi) = self.candidates(pos)
+        ends = self.ends
+        for i in range(lo, hi):
+            if ends[i] >= pos:
+                return self.rows[i]
+        return None
+
+    """(start, end, row) triples in start order
+    """
+    def items(self):
+        for i in range(len(self.starts)):
+            yield (self.starts[i], self.ends[i], self.rows[i])
+
+
+"""Rows pickled back to back in a mapped buffer, addressed by offsets
+"""
+class _PickledRows(object):
+    def __init__(self, buf, offsets):
+        self.buf = buf
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return pickle.loads(self.buf[self.offsets[i]:self.offsets[i + 1]])
+
+
+"""Writes one chromosome file
+"""
+def _write_chrom(path, intervals):
+    n = len(intervals)
+    blobs = [pickle.dumps(tuple(row), protocol=pickle.HIGHEST_PROTOCOL)
+        for row in intervals.rows]
+    offsets = array('q', [0])
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(MAGIC)
+        array('q', [n]).tofile(fh)
+        intervals.starts.tofile(fh)
+        intervals.ends.tofile(fh)
+        intervals.maxends.tofile(fh)
+        offsets.tofile(fh)
+        for b in blobs:
+            fh.write(b)
+    os.replace(tmp, path)
+
+
+"""Maps one chromosome file and returns its Intervals
+"""
+def _open_chrom(path):
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"Not an interval index file: {path}")
+
+    view = memoryview(mm)
+    n = view[8:16].cast('q')[0]
+    off = 16
+    arrays = []
+    for size in (n, n, n, n + 1):
+        arrays.append(view[off:off + 8 * size].cast('q'))
+        off = off + 8 * size
+    (starts, ends, maxends, offsets) = arrays
+    return Intervals(starts, ends, maxends, _PickledRows(view[off:], offsets))
+
+
+"""Interval index of one reference table
+   Chromosome files are mapped lazily on first lookup.
+"""
+class IntervalIndex(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        self.table = self.manifest['table']
+        self.kind = self.manifest.get('kind', 'sorted')
+        self._chroms = {}
+
+    """Intervals (or NCList) of chrom, None if the table has none there
+    """
+    def chrom(self, chrom):
+        if chrom not in self._chroms:
+            entry = self.manifest['chroms'].get(str(chrom))
+            if entry is None:
+                self._chroms[chrom] = None
+            elif (self.kind == 'nclist'):
+                self._chroms[chrom] = nclist.load(os.path.join(self.path,
+                    entry['file']))
+            else:
+                self._chroms[chrom] = _open_chrom(os.path.join(self.path,
+                    entry['file']))
+        return self._chroms[chrom]
+
+    def overlapping(self, chrom, pos):
+        intervals = self.chrom(chrom)
+        if intervals is None:
+            return []
+        return intervals.overlapping(int(pos))
+
+    def first(self, chrom, pos):
+        intervals = self.chrom(chrom)
+        if intervals is None:
+            return None
+        return intervals.first(int(pos))
+
+
+"""Opens every table index found under index_dir
+   Returns a dict of table name -> IntervalIndex
+"""
+def open_indexes(index_dir, tables=None):
+    indexes = {}
+    for table in (tables or TRACKS.keys()):
+        path = os.path.join(index_dir, table)
+        if os.path.isfile(os.path.join(path, MANIFEST)):
+            indexes[table] = IntervalIndex(path)
+    return indexes
+
+
+"""Builds the index of one table from the annotator database
+   Rows are selected whole (select *) so the annotators see the same
+   columns they get from MySQL.
+   kind - 'sorted' (Intervals) or 'nclist' (nclist.NCList)
+   backend - backends.Backend conn belongs to, MySQL by default
+"""
+def build(conn, table, index_dir, kind='sorted', backend=None):
+    (chrom_col, start_col, end_col) = TRACKS[table]
+    db = (backend or backends.MySQLBackend()).queries(conn)
+    rows = db.fetchall('table_intervals', table=table, chrom=chrom_col,
+        start=start_col, end=end_col)
+    db.cursor.close()
+    return build_from_rows(((row[0], row[1], row[2], row[3:]) for row in rows),
+        table, index_dir, kind=kind)
+
+
+"""Builds the index of one table from (chrom, start, end, row) tuples,
+   row being the whole table row
+"""
+def build_from_rows(rows, table, index_dir, kind='sorted'):
+    (chrom_col, start_col, end_col) = TRACKS[table]
+    path = os.path.join(index_dir, table)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    by_chrom = {}
+    for (chrom, start, end, row) in rows:
+        by_chrom.setdefault(str(chrom), []).append((start, end, tuple(row)))
+
+    chroms = {}
+    for (n, chrom) in enumerate(sorted(by_chrom)):
+        fname = str(n) + '.idx'
+        by_chrom[chrom] = in_row_order(by_chrom[chrom])
+        if (kind == 'nclist'):
+            intervals = nclist.NCList.from_rows(by_chrom[chrom])
+            nclist.save(os.path.join(path, fname), intervals)
+        else:
+            intervals = Intervals.from_rows(by_chrom[chrom])
+            _write_chrom(os.path.join(path, fname), intervals)
+        chroms[chrom] = {'file': fname, 'count': len(intervals)}
+
+    manifest = {
+        'table': table,
+        'kind': kind,
+        'columns': [chrom_col, start_col, end_col],
+        'built': int(time.time()),
+        'chroms': chroms
+    }
+    with open(os.path.join(path, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+
+    return manifest
+
+
+if __name__ == '__main__':
+    # Build indexes: python interval_index.py [--nclist] <index_dir> [table ...]
+    args = sys.argv[1:]
+    kind = 'sorted'
+    if (len(args) > 0) and (args[0] == '--nclist'):
+        kind = 'nclist'
+        args = args[1:]
+    if len(args) > 0:
+        tables = args[1:] or sorted(TRACKS.keys())
+        conn = u.db_connect()
+        for table in tables:
+            start = time.time()
+            manifest = build(conn, table, args[0], kind=kind)
+            count = sum([c['count'] for c in manifest['chroms'].values()])
+            print(f"{table}: {count} intervals in {time.time() - start:.2f} seconds")
+        conn.close()
+    else:
+        print("Usage: python interval_index.py [--nclist] <index_dir> [table ...]")
+
+### EOF
@@ -0,0 +1,130 @@
+# lookup_cache.py
+#
+# Process-wide LRU cache of per-position reference lookups
+#
+# The database-backed annotators keep the rows they fetch for a position
+# here, keyed by (table, chrom, pos[, ref, alt]). The cache is a module
+# level singleton, so it outlives a single job when several jobs run in
+# the same process. It is emptied whenever the reference version given to
+# set_version() changes.
+#
+# MODELS holds what is built from whole chromosomes of a reference table
+# (the transcript models and CpG islands of annotate.py), so the jobs of
+# a process build each chromosome once per reference version.
+#
+##
+
+import os
+from collections import OrderedDict
+
+# Entries kept before the least recently used ones are evicted; 0 turns
+# the cache off
+LOOKUP_CACHE_SIZE = int(os.environ['ANN_LOOKUP_CACHE_SIZE']) if \
+    ('ANN_LOOKUP_CACHE_SIZE' in os.environ) else 200000
+
+# Returned by get() for keys not in the cache (None is a valid value)
+MISS = object()
+
+
+"""Bounded mapping evicting the least recently used entry
+   Values must not be modified once stored; the annotators store the
+   tuples returned by the cursor.
+"""
+class LRUCache(object):
+    def __init__(self, size=LOOKUP_CACHE_SIZE):
+        self.size = size
+        self.version = None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        value = self._entries.get(key, MISS)
+        if value is MISS:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if (self.size <= 0):
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while (len(self._entries) > self.size):
+            self._entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def clear(self):
+        self._entries.clear()
+
+    """Empties the cache if the reference data is not the version the
+       cached rows were read from
+    """
+    def set_version(self, version):
+        if (version != self.version):
+            if (len(self._entries) > 0):
+                print(f"Reference version changed to {version}, " + \
+                    f"dropping {len(self._entries)} cached lookups")
+            self.clear()
+            self.version = version
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits,
+            'misses': self.misses, 'evictions': self.evictions}
+
+
+"""Per-chromosome models built from the reference tables, kept for the
+   life of the process and emptied when the reference version changes
+"""
+class ModelCache(object):
+    def __init__(self):
+        self.version = None
+        self._models = {}
+        self.builds = 0
+
+    def __len__(self):
+        return len(self._models)
+
+    """Model stored under key, built with build() if it is not there yet
+    """
+    def get(self, key, build):
+        model = self._models.get(key)
+        if model is None:
+            model = build()
+            self._models[key] = model
+            self.builds = self.builds + 1
+        return model
+
+    def clear(self):
+        self._models.clear()
+
+    def set_version(self, version):
+        if (version != self.version):
+            self.clear()
+            self.version = version
+
+
+CACHE = LRUCache()
+MODELS = ModelCache()
+
+
+"""Sets the reference version of both CACHE and MODELS
+"""
+def set_version(version):
+    CACHE.set_version(version)
+    MODELS.set_version(version)
+
+
+"""Empties both CACHE and MODELS
+"""
+def clear():
+    CACHE.clear()
+    MODELS.clear()
+
+### EOF
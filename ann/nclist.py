@@ -0,0 +1,186 @@
+# nclist.py
+#
+# Nested containment list of reference intervals
+#
+# Sorted arrays (interval_index.Intervals) bound a lookup with the running
+# max of ends, which degrades when long intervals contain many short ones
+# (genomicSuperDups, tfbsConsSites). An NCList splits the intervals into
+# lists in which no interval contains another, so within a list both
+# starts and ends are increasing; every interval points to the sublist of
+# the intervals it contains. A lookup bisects one list and only descends
+# into the sublists of intervals that overlap the position.
+#
+# The lists are stored back to back in flat int64 arrays, which are
+# written to and mapped from a file in the same way as the interval index.
+#
+##
+
+import bisect
+import mmap
+import os
+import pickle
+from array import array
+from collections import deque
+
+import interval_index as ii
+
+MAGIC = b'ANNNCL01'
+
+
+"""Intervals of one chromosome as a nested containment list
+   A position overlaps interval i when starts[i] <= pos <= ends[i].
+   The top list is [0, top); the sublist of interval i is
+   [sub_offset[i], sub_offset[i] + sub_count[i]). ranks[i] is the place
+   of interval i in (start, end) order, in which overlaps are returned.
+"""
+class NCList(object):
+    def __init__(self, starts, ends, ranks, sub_offset, sub_count, rows, top):
+        self.starts = starts
+        self.ends = ends
+        self.ranks = ranks
+        self.sub_offset = sub_offset
+        self.sub_count = sub_count
+        self.rows = rows
+        self.top = top
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Builds the lists from (start, end, row) triples, e.g. a table dump
+    """
+    @classmethod
+    def from_rows(cls, triples):
+        triples = [(int(s), int(e), row) for (s, e, row) in triples]
+        n = len(triples)
+        ranks = [0] * n
+        for (rank, i) in enumerate(sorted(range(n),
+            key=lambda i: (triples[i][0], triples[i][1]))):
+            ranks[i] = rank
+
+        # Parent of each interval: the nearest one containing it
+        children = {-1: []}
+        stack = []
+        for i in sorted(range(n),
+            key=lambda i: (triples[i][0], -triples[i][1], ranks[i])):
+            while (len(stack) > 0) and (triples[stack[-1]][1] < triples[i][1]):
+                stack.pop()
+            children.setdefault(stack[-1] if (len(stack) > 0) else -1, []).append(i)
+            stack.append(i)
+
+        # Lay the lists out breadth first, the top list at 0
+        order = []
+        offsets = {}
+        queue = deque([-1])
+        while (len(queue) > 0):
+            parent = queue.popleft()
+            kids = children.get(parent, [])
+            offsets[parent] = len(order)
+            order.extend(kids)
+            queue.extend(kids)
+
+        nc = cls(array('q'), array('q'), array('q'), array('q'), array('q'),
+            [], len(children[-1]))
+        for i in order:
+            (start, end, row) = triples[i]
+            nc.starts.append(start)
+            nc.ends.append(end)
+            nc.ranks.append(ranks[i])
+            kids = children.get(i, [])
+            nc.sub_offset.append(offsets[i] if (len(kids) > 0) else 0)
+            nc.sub_count.append(len(kids))
+            nc.rows.append(row)
+        return nc
+
+    """Flat indices of the intervals overlapping pos, unordered
+    """
+    def _search(self, pos):
+        found = []
+        lists = [(0, self.top)]
+        starts = self.starts
+        ends = self.ends
+        while (len(lists) > 0):
+            (lo, hi) = lists.pop()
+            # Ends are increasing within a list
+            k = bisect.bisect_left(ends, pos, lo, hi)
+            while (k < hi) and (starts[k] <= pos):
+                found.append(k)
+                if (self.sub_count[k] > 0):
+                    offset = self.sub_offset[k]
+                    lists.append((offset, offset + self.sub_count[k]))
+                k = k + 1
+        return found
+
+    """All rows overlapping pos, in (start, end) order (fetchall semantics)
+    """
+    def overlapping(self, pos):
+        ranks = self.ranks
+        return [self.rows[i] for i in sorted(self._search(pos),
+            key=lambda i: ranks[i])]
+
+    """First row overlapping pos in (start, end) order, or None
+       (fetchone semantics)
+    """
+    def first(self, pos):
+        found = self._search(pos)
+        if (len(found) == 0):
+            return None
+        ranks = self.ranks
+        return self.rows[min(found, key=lambda i: ranks[i])]
+
+    """(start, end, row) triples in (start, end) order
+    """
+    def items(self):
+        for i in sorted(range(len(self.starts)), key=lambda i: self.ranks[i]):
+            yield (self.starts[i], self.ends[i], self.rows[i])
+
+    """Pickles as plain arrays and a row list, whatever the storage
+    """
+    def __reduce__(self):
+        return (NCList, (array('q', self.starts), array('q', self.ends),
+            array('q', self.ranks), array('q', self.sub_offset),
+            array('q', self.sub_count), [self.rows[i] for i in range(len(self))],
+            self.top))
+
+
+"""Writes an NCList to path
+"""
+def save(path, nc):
+    n = len(nc)
+    blobs = [pickle.dumps(tuple(nc.rows[i]), protocol=pickle.HIGHEST_PROTOCOL)
+        for i in range(n)]
+    offsets = array('q', [0])
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fh:
+        fh.write(MAGIC)
+        array('q', [n, nc.top]).tofile(fh)
+        for a in (nc.starts, nc.ends, nc.ranks, nc.sub_offset, nc.sub_count):
+            array('q', a).tofile(fh)
+        offsets.tofile(fh)
+        for b in blobs:
+            fh.write(b)
+    os.replace(tmp, path)
+
+
+"""Maps an NCList file written by save()
+"""
+def load(path):
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"Not an NCList file: {path}")
+
+    view = memoryview(mm)
+    (n, top) = view[8:24].cast('q')
+    off = 24
+    arrays = []
+    for size in (n, n, n, n, n, n + 1):
+        arrays.append(view[off:off + 8 * size].cast('q'))
+        off = off + 8 * size
+    (starts, ends, ranks, sub_offset, sub_count, offsets) = arrays
+    return NCList(starts, ends, ranks, sub_offset, sub_count,
+        ii._PickledRows(view[off:], offsets), top)
+
+### EOF
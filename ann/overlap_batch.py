@@ -0,0 +1,76 @@
+# overlap_batch.py
+#
+# Vectorized overlap of a batch of positions against one chromosome
+#
+# Uses the same layout as interval_index.Intervals (intervals sorted by
+# start, plus the running max of their ends) but resolves every position
+# of a batch at once with numpy.searchsorted instead of one bisection per
+# variant. numpy is optional; without it available() is False and the
+# overlap stages keep their per-variant lookups.
+#
+##
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def available():
+    return np is not None
+
+
+"""numpy view of the intervals of one chromosome
+   The arrays of an interval_index.Intervals (array('q') or a mapped
+   memoryview) are wrapped without copying.
+"""
+class BatchIntervals(object):
+    def __init__(self, intervals):
+        self.starts = np.asarray(intervals.starts, dtype=np.int64)
+        self.ends = np.asarray(intervals.ends, dtype=np.int64)
+        self.maxends = np.asarray(intervals.maxends, dtype=np.int64)
+        self.rows = intervals.rows
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Candidate index ranges [lo, hi) of every position
+       Intervals starting after pos are past hi; those before lo end
+       before pos, since maxends is non-decreasing.
+    """
+    def candidates(self, positions):
+        hi = np.searchsorted(self.starts, positions, side='right')
+        lo = np.searchsorted(self.maxends, positions, side='left')
+        return (np.minimum(lo, hi), hi)
+
+    """All (position index, interval index) pairs that overlap, ordered
+       by position index and then interval index
+    """
+    def matches(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        (lo, hi) = self.candidates(positions)
+        counts = hi - lo
+        total = int(counts.sum())
+        if (total == 0):
+            empty = np.zeros(0, dtype=np.int64)
+            return (empty, empty)
+
+        var = np.repeat(np.arange(len(positions)), counts)
+        firsts = np.cumsum(counts) - counts
+        idx = np.arange(total) - np.repeat(firsts - lo, counts)
+        keep = self.ends[idx] >= positions[var]
+        return (var[keep], idx[keep])
+
+    """Rows overlapping each position, as one list per position, in the
+       order of the Intervals (fetchall semantics; the first of each list
+       is the fetchone row)
+    """
+    def overlapping(self, positions):
+        result = [[] for p in positions]
+        (var, idx) = self.matches(positions)
+        rows = self.rows
+        for (v, i) in zip(var.tolist(), idx.tolist()):
+            result[v].append(rows[i])
+        return result
+
+### EOF
@@ -0,0 +1,376 @@
+# pipeline.py
+#
+# Fused annotation engine
+#
+# Each line of the input is parsed once into a Record and passed, in
+# batches, through every annotator in order. The annotated file and the
+# .count.log are written once at the end, instead of chaining the
+# annotators through one temp file per stage.
+#
+# run_parallel splits the input by chromosome and runs the shards in a
+# process pool, merging the outputs and the counts back together.
+#
+# Given a list of StageStats (see stage_stats), the engine records the
+# wall and CPU time, variants and database queries of every stage.
+#
+##
+
+import gzip
+import multiprocessing
+import os
+import time
+from array import array
+
+import backends
+import file_utils as fu
+import queries
+import utils as u
+
+"""A parsed VCF (or pileup) data line
+   chrom is the chromosome without the "chr" prefix, ucsc_chrom with it;
+   the annotators edit fields in place.
+"""
+class Record(object):
+    __slots__ = ('fields', 'chrom', 'ucsc_chrom', 'pos', 'ref', 'alt')
+
+    def __init__(self, fields, inds):
+        self.fields = fields
+        chrom = fields[inds[0]].strip()
+        if chrom.startswith("chr"):
+            chrom = chrom.replace('chr', '')
+        self.chrom = chrom
+        self.ucsc_chrom = 'chr' + chrom
+        self.pos = int(fields[inds[1]].strip())
+        self.ref = fields[inds[2]].strip()
+        self.alt = fields[inds[3]].strip()
+
+
+"""Header lines are kept as strings, data lines become Records
+"""
+def is_header(line):
+    return line.startswith('#') or line.startswith('CHROM')
+
+
+"""Reads fh in batches of batch_size data lines
+   Each batch is a list of header strings and Records in file order.
+"""
+def read_batches(fh, format='vcf', sep='\t', batch_size=1000):
+    inds = u.getFormatSpecificIndices(format=format)
+    batch = []
+    count = 0
+    for line in fh:
+        line = line.strip()
+        if (len(line) == 0):
+            continue
+        if is_header(line):
+            batch.append(line)
+        else:
+            batch.append(Record(line.split(sep), inds))
+            count = count + 1
+            if (count >= batch_size):
+                yield batch
+                batch = []
+                count = 0
+    if (len(batch) > 0):
+        yield batch
+
+
+def records_of(batch):
+    return [item for item in batch if isinstance(item, Record)]
+
+
+def write_batch(fh_out, batch, sep='\t'):
+    for item in batch:
+        if isinstance(item, Record):
+            fh_out.write(sep.join([str(x) for x in item.fields]) + '\n')
+        else:
+            fh_out.write(item + '\n')
+
+
+"""Time and queries of one annotation stage
+   With parallel workers, the times are summed over the workers.
+"""
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.variants = 0
+        self.queries = queries.QueryStats()
+
+    def merge(self, other):
+        self.wall = self.wall + other.wall
+        self.cpu = self.cpu + other.cpu
+        self.variants = self.variants + other.variants
+        self.queries.merge(other.queries)
+
+    def summary(self):
+        summary = {'stage': self.name, 'wall_s': round(self.wall, 4),
+            'cpu_s': round(self.cpu, 4), 'variants': self.variants}
+        summary.update(self.queries.summary())
+        return summary
+
+
+"""Name of an annotation stage: its class, and table if it has one
+"""
+def stage_name(annotator):
+    table = getattr(annotator, 'table', None)
+    return type(annotator).__name__ + (f"({table})" if table else '')
+
+
+"""New StageStats for each of annotators, in order
+"""
+def stage_stats(annotators):
+    return [StageStats(stage_name(a)) for a in annotators]
+
+
+"""Runs annotators over infile in a single pass
+   Writes the annotated records to outfile and the annotators' counts to
+   logfile (opened with logmode). infile may be gzip/BGZF compressed.
+   See run_stream for conn, backend, stats and store.
+"""
+def run(annotators, infile, outfile, logfile, format='vcf', sep='\t',
+    batch_size=1000, logmode='w', conn=None, backend=None, stats=None,
+    store=None):
+
+    with fu.open_vcf(infile) as fh, open(outfile, 'w') as fh_out:
+        variants = run_stream(annotators, fh, fh_out, format=format, sep=sep,
+            batch_size=batch_size, conn=conn, backend=backend, stats=stats,
+            store=store)
+
+    if logfile is not None:
+        write_log(annotators, logfile, logmode=logmode)
+
+    return variants
+
+
+"""Runs annotators over the text stream fh, writing to fh_out
+   fh_out only needs a write() method (e.g. s3_stream.MultipartWriter).
+   A database connection is opened on
+   backend (MySQL by default) only if one of the annotators needs it, and
+   shared by all of them through one queries.Queries.
+   stats - optional StageStats of every annotator (see stage_stats)
+   store - optional variant_store.VariantStore (see annotate_batch)
+"""
+def run_stream(annotators, fh, fh_out, format='vcf', sep='\t',
+    batch_size=1000, conn=None, backend=None, stats=None, store=None):
+
+    own_conn = False
+    db = None
+    if any([a.uses_database() for a in annotators]):
+        backend = backend or backends.MySQLBackend()
+        if conn is None:
+            conn = backend.connect()
+            own_conn = True
+        db = backend.queries(conn)
+        for a in annotators:
+            a.db = db
+
+    variants = 0
+    try:
+        for batch in read_batches(fh, format=format, sep=sep,
+            batch_size=batch_size):
+            records = records_of(batch)
+            annotate_batch(annotators, records, stats=stats, db=db,
+                store=store)
+            write_batch(fh_out, batch, sep=sep)
+            variants = variants + len(records)
+    finally:
+        if db is not None:
+            db.stats = None
+        if own_conn:
+            conn.close()
+
+    return variants
+
+
+"""Runs the annotators over a batch of records
+   stats - optional StageStats of every annotator, given the times and
+   queries of its stage
+   store - optional variant_store.VariantStore; records found in it are
+   annotated from it, the others go through the annotators and their
+   results are stored
+"""
+def annotate_batch(annotators, records, stats=None, db=None, store=None):
+    capture = None
+    if store is not None:
+        records = store.apply(records, annotators)
+        if (len(records) == 0):
+            return
+        capture = store.capture(records)
+    for (i, a) in enumerate(annotators):
+        if capture is not None:
+            capture.begin(a)
+        if stats is None:
+            a.annotate(records)
+        else:
+            annotate_timed(a, records, stats[i], db)
+        if capture is not None:
+            capture.end(a)
+    if capture is not None:
+        store.put(capture)
+
+
+"""Runs one annotator over records, adding its times and queries to
+   stage (a StageStats)
+"""
+def annotate_timed(annotator, records, stage, db=None):
+    if db is not None:
+        db.stats = stage.queries
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    annotator.annotate(records)
+    stage.cpu = stage.cpu + time.process_time() - cpu
+    stage.wall = stage.wall + time.perf_counter() - wall
+    stage.variants = stage.variants + len(records)
+
+
+def write_log(annotators, logfile, logmode='w'):
+    with open(logfile, logmode) as fh_log:
+        fh_log.write(log_text(annotators))
+
+
+"""The annotators' counts, as written to the .count.log
+"""
+def log_text(annotators):
+    return ''.join([line + '\n' for a in annotators for line in a.summary()])
+
+
+# Database connection of a pool worker, opened by its first shard
+_worker_conn = None
+
+"""Annotates one shard in a pool worker
+   Returns the counts and StageStats of every annotator, in order, and
+   the variant store stats of the shard (or None).
+"""
+def _annotate_shard(args):
+    global _worker_conn
+    (make_annotators, annotator_args, infile, outfile, format, sep,
+        batch_size, backend, store) = args
+
+    annotators = make_annotators(**annotator_args)
+    if (_worker_conn is None) and \
+        any([a.uses_database() for a in annotators]):
+        _worker_conn = backend.connect()
+
+    stats = stage_stats(annotators)
+    store_stats = None
+    if store is not None:
+        start = store.stats()
+    try:
+        run(annotators, infile, outfile, None, format=format, sep=sep,
+            batch_size=batch_size, conn=_worker_conn, backend=backend,
+            stats=stats, store=store)
+    finally:
+        if store is not None:
+            store.close()
+    if store is not None:
+        store_stats = store.stats(since=start)
+    return ([a.counts for a in annotators], stats, store_stats)
+
+
+# Shard index marking a header line in the order returned by split_by_chrom
+HEADER = 0xFFFFFFFF
+
+"""Splits infile into one shard file per chromosome
+   Shards of a compressed infile are written gzip compressed (at a fast
+   level), so its plain text is never written out; fu.open_vcf reads both.
+   Returns (shard paths, header lines, order), where order holds for every
+   line of infile the index of its shard, or HEADER.
+"""
+def split_by_chrom(infile, format='vcf', sep='\t'):
+    inds = u.getFormatSpecificIndices(format=format)
+    compressed = fu.is_gzip(infile)
+    shards = {}
+    paths = []
+    handles = []
+    headers = []
+    order = array('I')
+
+    with fu.open_vcf(infile) as fh:
+        for line in fh:
+            line = line.strip()
+            if (len(line) == 0):
+                continue
+            if is_header(line):
+                headers.append(line)
+                order.append(HEADER)
+                continue
+
+            chrom = line.split(sep, inds[0] + 1)[inds[0]].strip()
+            if chrom not in shards:
+                shards[chrom] = len(paths)
+                paths.append(fu.uncompressed_name(infile) + '.shard' + \
+                    str(len(paths)) + ('.gz' if compressed else ''))
+                if compressed:
+                    handles.append(gzip.open(paths[-1], 'wt', compresslevel=1))
+                else:
+                    handles.append(open(paths[-1], 'w'))
+            handles[shards[chrom]].write(line + '\n')
+            order.append(shards[chrom])
+
+    for h in handles:
+        h.close()
+    return (paths, headers, order)
+
+
+"""Annotates infile with one shard per chromosome in a pool of workers
+   Every worker holds a single database connection for all the shards it
+   annotates. Shard outputs are merged back in the original line order
+   and the counts of each annotator are summed before writing logfile.
+   make_annotators must be a module level function so workers can build
+   their own annotators from annotator_args. backend must fork (see
+   backends.Backend). The StageStats of the shards are merged into stats,
+   if given. Each worker opens its own connection to store, if given, and
+   its hits and misses are added to store.
+"""
+def run_parallel(make_annotators, infile, outfile, logfile, workers=2,
+    format='vcf', sep='\t', batch_size=1000, annotator_args={},
+    backend=None, stats=None, store=None):
+
+    backend = backend or backends.MySQLBackend()
+
+    (paths, headers, order) = split_by_chrom(infile, format=format, sep=sep)
+    outs = [fu.uncompressed_name(path) + '.annot' for path in paths]
+
+    # Largest shards first so the pool is not left waiting on one of them
+    jobs = sorted(range(len(paths)), key=lambda i: -os.path.getsize(paths[i]))
+    args = [(make_annotators, annotator_args, paths[i], outs[i], format, sep,
+        batch_size, backend, store) for i in jobs]
+
+    try:
+        workers = max(1, min(workers, len(paths)))
+        with multiprocessing.Pool(processes=workers) as pool:
+            shard_results = pool.map(_annotate_shard, args, chunksize=1)
+
+        annotators = make_annotators(**annotator_args)
+        for (counts, shard_stats, store_stats) in shard_results:
+            for (a, c) in zip(annotators, counts):
+                for key, n in c.items():
+                    a.count(key, n)
+            if stats is not None:
+                for (stage, shard_stage) in zip(stats, shard_stats):
+                    stage.merge(shard_stage)
+            if store_stats is not None:
+                store.merge(store_stats)
+
+        shard_fhs = [open(path) for path in outs]
+        header_lines = iter(headers)
+        with open(outfile, 'w') as fh_out:
+            for shard in order:
+                if (shard == HEADER):
+                    fh_out.write(next(header_lines) + '\n')
+                else:
+                    fh_out.write(shard_fhs[shard].readline())
+        for fh in shard_fhs:
+            fh.close()
+
+    finally:
+        for path in paths + outs:
+            if os.path.isfile(path):
+                os.unlink(path)
+
+    write_log(annotators, logfile)
+    return len(order) - len(headers)
+
+### EOF
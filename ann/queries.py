@@ -0,0 +1,217 @@
+# queries.py
+#
+# Named, parameterized statements for the annotator database
+#
+# Values are always passed as parameters, never spliced into the SQL.
+# Identifiers (table and column names) are filled in from the statement
+# templates and must be plain names. A statement may end with one IN
+# list, which is padded to a power of two so the number of distinct
+# statement shapes stays small.
+#
+# Parameters are bound client side by the driver. Statements are written
+# with %s placeholders; with paramstyle='qmark' (SQLite, see backends.py)
+# they become ?.
+#
+# When stats is set to a QueryStats, every statement run is counted with
+# the rows fetched from it and its latency (execute to first fetch).
+#
+##
+
+import re
+import time
+from array import array
+
+STATEMENTS = {
+    # dbSNP rows at any of positions ({positions} must come last)
+    'dbsnp_by_positions':
+        'select POS, REF, dbSNP.* from dbSNP where CHR=%s AND INFO=%s ' +
+        'AND POS in ({positions})',
+
+    'bigrefgene_equal_base':
+        'select * from chrom_pos_equal_base where CHR=%s AND start=%s ' +
+        'AND ((haplotypeReference=%s AND haplotypeAlternate=%s) OR ' +
+        '(haplotypeReference=%s AND haplotypeAlternate=%s))',
+    'bigrefgene_equal_nobase':
+        'select * from chrom_pos_equal_nobase where CHR=%s AND start=%s',
+    'bigrefgene_unequal':
+        'select * from chrom_pos_unequal where CHR=%s AND start <= %s ' +
+        'AND %s <= end',
+
+    # Transcripts of a gene table
+    'transcripts_of_chrom':
+        'select * from {table} where chrom=%s order by txStart, txEnd',
+    'cpg_islands_of_chrom':
+        'select chromStart, chromEnd, chrom, chromStart, chromEnd, name ' +
+        'from cpgIslandExt where chrom=%s order by chromStart',
+
+    # Interval tables
+    'overlap':
+        'select * from {table} where {chrom}=%s AND ({start} <= %s ' +
+        'AND %s <= {end}) order by {start}, {end}',
+    'intervals_of_chrom':
+        'select {start}, {end}, {table}.* from {table} where {chrom}=%s ' +
+        'order by {start}, {end}',
+    'table_intervals':
+        'select {chrom}, {start}, {end}, {table}.* from {table}',
+    'table_dump':
+        'select * from {table}',
+
+    # tfbsConsSites is split in one table per chromosome
+    'tfbs_overlap':
+        'select chrom, chromStart, chromEnd, name from {table} ' +
+        'where chromStart <= %s AND %s <= chromEnd ' +
+        'order by chromStart, chromEnd',
+    'tfbs_intervals':
+        'select chromStart, chromEnd, chrom, chromStart, chromEnd, name ' +
+        'from {table} order by chromStart, chromEnd',
+
+    # gwasCatalog is matched on chromEnd only
+    'gwas_at':
+        'select * from {table} where chrom=%s AND chromEnd=%s',
+    'gwas_intervals':
+        'select chromEnd, chromEnd, {table}.* from {table} where chrom=%s ' +
+        'order by chromEnd',
+}
+
+IDENTIFIER = re.compile(r'^[A-Za-z0-9_]+$')
+LIST = re.compile(r' in \(\{(\w+)\}\)$')
+
+
+"""Size an IN list of n values is padded to
+"""
+def list_bucket(n):
+    size = 8
+    while size < n:
+        size = size * 2
+    return size
+
+
+"""Statements run, rows fetched and query latencies
+"""
+class QueryStats(object):
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.latencies = array('d')
+
+    def merge(self, other):
+        self.queries = self.queries + other.queries
+        self.rows = self.rows + other.rows
+        self.latencies.extend(other.latencies)
+
+    """Latency percentile p (0-100) in seconds, nearest rank
+    """
+    def percentile(self, p):
+        if (len(self.latencies) == 0):
+            return None
+        ordered = sorted(self.latencies)
+        rank = max(1, -(-len(ordered) * p // 100))
+        return ordered[int(rank) - 1]
+
+    def summary(self):
+        p50 = self.percentile(50)
+        p99 = self.percentile(99)
+        return {'queries': self.queries, 'rows': self.rows,
+            'p50_ms': None if p50 is None else round(p50 * 1000, 3),
+            'p99_ms': None if p99 is None else round(p99 * 1000, 3)}
+
+
+"""Cursor that counts the rows fetched from it into a QueryStats
+   The latency of the statement is recorded at its first fetch.
+"""
+class _CountingCursor(object):
+    def __init__(self, cursor, stats, start):
+        self._cursor = cursor
+        self._stats = stats
+        self._start = start
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _fetched(self, n):
+        if self._start is not None:
+            self._stats.latencies.append(time.perf_counter() - self._start)
+            self._start = None
+        self._stats.rows = self._stats.rows + n
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._fetched(0 if row is None else 1)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size else self._cursor.fetchmany()
+        self._fetched(len(rows))
+        return rows
+
+
+"""Statements run over one connection
+   All the annotators of a job share one instance (and one cursor).
+   paramstyle - 'format' (pymysql) or 'qmark' (sqlite3)
+   cursor - cursor to run the statements on, a new one by default
+"""
+class Queries(object):
+    def __init__(self, conn, paramstyle='format', cursor=None):
+        self.conn = conn
+        self.cursor = conn.cursor() if cursor is None else cursor
+        self.paramstyle = paramstyle
+        self._sql = {}
+        self.stats = None
+
+    """SQL text of a statement, identifiers filled in
+       values - length of the trailing IN list, if the statement has one
+    """
+    def statement(self, name, values=0, **identifiers):
+        key = (name, values, tuple(sorted(identifiers.items())))
+        if key not in self._sql:
+            for v in identifiers.values():
+                if not IDENTIFIER.match(str(v)):
+                    raise ValueError(f"Invalid identifier in {name}: {v}")
+            template = STATEMENTS[name]
+            m = LIST.search(template)
+            if m is not None:
+                identifiers = dict(identifiers)
+                identifiers[m.group(1)] = ','.join(['%s'] * values)
+            sql = template.format(**identifiers)
+            if (self.paramstyle == 'qmark'):
+                sql = sql.replace('%s', '?')
+            self._sql[key] = sql
+        return self._sql[key]
+
+    """Runs a statement; returns the cursor holding its result
+       params - parameter values in statement order
+       values - values of the trailing IN list, if any
+    """
+    def execute(self, name, params=(), values=None, **identifiers):
+        params = list(params)
+        size = 0
+        if values is not None:
+            values = list(values)
+            size = list_bucket(len(values))
+            params = params + values + [values[-1]] * (size - len(values))
+        sql = self.statement(name, values=size, **identifiers)
+
+        start = time.perf_counter()
+        if (len(params) > 0):
+            self.cursor.execute(sql, params)
+        else:
+            self.cursor.execute(sql)
+        if self.stats is None:
+            return self.cursor
+        self.stats.queries = self.stats.queries + 1
+        return _CountingCursor(self.cursor, self.stats, start)
+
+    def fetchall(self, name, params=(), values=None, **identifiers):
+        return self.execute(name, params, values=values,
+            **identifiers).fetchall()
+
+    def fetchone(self, name, params=(), values=None, **identifiers):
+        return self.execute(name, params, values=values,
+            **identifiers).fetchone()
+
+### EOF
@@ -0,0 +1,107 @@
+# result_index.py
+#
+# Reuse of the results of identical annotation jobs
+#
+# A job's input is identified by the sha256 of its bytes and the
+# reference data version it is annotated against. After a job completes
+# its result keys are recorded under that identity in the results bucket,
+# as <root>/result-index/<reference version>/<sha256>.json; a later job
+# with the same input and version copies those result objects to its own
+# keys (server side) instead of running the pipeline again.
+#
+# An input streamed from S3 is not read just to hash it: its digest is
+# the SHA-256 checksum S3 keeps for objects uploaded with one, and a job
+# without it hashes the input as it streams it (driver.run_s3) and
+# records its results afterwards.
+#
+##
+
+import base64
+import hashlib
+import json
+import time
+
+from botocore.exceptions import ClientError
+
+import s3_stream
+
+BLOCK_SIZE = 1024 * 1024
+
+
+"""sha256 hex digest of what is read from a binary file object
+"""
+def digest(fh):
+    sha = hashlib.sha256()
+    for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+        sha.update(block)
+    return sha.hexdigest()
+
+
+"""sha256 of a job input, a local file or an s3:// URL
+   The object at an s3:// URL is not read: the result is its SHA-256
+   checksum, or None if it was not uploaded with a full object one.
+"""
+def input_digest(s3_client, input_path):
+    if input_path.startswith('s3://'):
+        (bucket, key) = s3_stream.parse_url(input_path)
+        response = s3_client.head_object(Bucket=bucket, Key=key,
+            ChecksumMode='ENABLED')
+        checksum = response.get('ChecksumSHA256')
+        # multipart uploads have a checksum of the part checksums, '<b64>-<parts>'
+        if (checksum is None) or ('-' in checksum) or \
+            (response.get('ChecksumType', 'FULL_OBJECT') != 'FULL_OBJECT'):
+            return None
+        return base64.b64decode(checksum).hex()
+    with open(input_path, 'rb') as fh:
+        return digest(fh)
+
+
+def index_key(root, reference_version, sha):
+    return f"{root}/result-index/{reference_version}/{sha}.json"
+
+
+"""The index entry stored at key, or None if there is none
+"""
+def lookup(s3_client, bucket, key):
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    except ClientError:
+        return None
+    try:
+        return json.loads(body.read())
+    except ValueError:
+        return None
+    finally:
+        body.close()
+
+
+"""Copies the result objects of an entry to new keys
+   keys - result name ('annot', 'log', 'stats') -> key to copy it to
+   Returns False, after printing why, if any object could not be copied;
+   the job then has to be run.
+"""
+def copy_results(s3_client, entry, bucket, keys):
+    try:
+        for name, key in keys.items():
+            s3_client.copy_object(Bucket=bucket, Key=key,
+                CopySource={'Bucket': entry['bucket'], 'Key': entry['keys'][name]})
+    except (ClientError, KeyError) as e:
+        print(f"Could not reuse the results of job {entry.get('job_id')}: {e}")
+        return False
+    return True
+
+
+"""Records the results of a completed job under key
+   keys - result name -> key of the job's result object in bucket
+"""
+def record(s3_client, bucket, key, job_id, keys, stats):
+    entry = {'job_id': job_id, 'bucket': bucket, 'keys': keys,
+        'stats': stats, 'created': int(time.time())}
+    try:
+        s3_client.put_object(Bucket=bucket, Key=key,
+            Body=json.dumps(entry).encode('utf-8'),
+            ContentType='application/json')
+    except ClientError as e:
+        print(f"Could not record the results of job {job_id}: {e}")
+
+### EOF
@@ -1,25 +1,36 @@
 ###
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import boto3, driver, json, os, shutil, sys, time
+import backends, boto3, driver, hashlib, json, os, result_index, shutil, sys, time
+import file_utils as fu
 from botocore.config import Config
 from botocore.exceptions import ClientError, ParamValidationError
 from configparser import SafeConfigParser
+from decimal import Decimal
+from variant_store import VariantStore
 
 # Get annotator configuration
 config = SafeConfigParser(os.environ)
 config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
 
-# connect to AWS resources (S3, dynamo, sns) and get AWS credentials
-aws_config = Config(region_name=config['aws']['AwsRegionName'], signature_version=config['aws']['SignatureVersion'])
-try: 
-    s3_client = boto3.client('s3', config=aws_config)
-    dynamo = boto3.resource('dynamodb')
-    dynamo_table = dynamo.Table(config['aws']['DynamoTableName'])
-    sns = boto3.client('sns')
-except ClientError as e:
-    print(f"Unexpected error: {e}")
-    exit()
+# AWS clients (S3, dynamo, sns), created by connect_aws() once per process
+s3_client = None
+dynamo_table = None
+sns = None
+
+"""Connects to AWS resources (S3, dynamo, sns) and gets AWS credentials
+"""
+def connect_aws():
+    global s3_client, dynamo_table, sns
+    aws_config = Config(region_name=config['aws']['AwsRegionName'], signature_version=config['aws']['SignatureVersion'])
+    try: 
+        s3_client = boto3.client('s3', config=aws_config)
+        dynamo = boto3.resource('dynamodb')
+        dynamo_table = dynamo.Table(config['aws']['DynamoTableName'])
+        sns = boto3.client('sns')
+    except ClientError as e:
+        print(f"Unexpected error: {e}")
+        exit()
 
 """A rudimentary timer for coarse-grained profiling
 """
@@ -37,91 +48,240 @@ class Timer(object):
     if self.verbose:
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
-if __name__ == '__main__':
-    # Call the AnnTools pipeline
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-            bucket_name = config['aws']['ResultsBucketName']
+# Backend the reference tables are read from, opened once per process
+backend = None
+# Per-variant annotation store, if configured, opened once per process
+variant_store = None
 
-            try:
-                job_id = sys.argv[3]
-                input_file_name = sys.argv[5]
-                user_id = sys.argv[7]
-                user_email = sys.argv[9]
-            except IndexError as e:
-               print("Job ID parameter not given")
-               exit()
-            
-            file_prefix = input_file_name[:-4]
-            annot_file = file_prefix + ".annot.vcf"
-            log_file = file_prefix + ".vcf.count.log"
-            s3_key_name = config['aws']['BucketObjectRoot'] + "/" + user_id + "/"
-
-            # define local job directory to clean up once files are uploaded to S3
-            clean_up_folder = config['annotation_output']['OutputFolder'] + "/" + job_id
-
-            # upload annotation job output files to S3
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-            try:
-                with open(clean_up_folder + "/" + annot_file, "rb") as file1:
-                    s3_client.upload_fileobj(file1, bucket_name, s3_key_name + job_id + "~" + annot_file)
-                with open(clean_up_folder + "/" + log_file, "rb") as file2:
-                    s3_client.upload_fileobj(file2, bucket_name, s3_key_name + job_id + "~" + log_file)
-            except ClientError as e:
-               print(e)
-
-            # update DynamoDB with output files
-            try:
-                dynamo_table.update_item(
-                    Key={'job_id': job_id},
-                    UpdateExpression="SET #attr1 = :new_status, #attr2 = :result_file, #attr3 = :log_file, #attr4 = :complete_time, #attr5 = :bucket",
-                    ConditionExpression="job_status = :expected_status",
-                    ExpressionAttributeNames={
-                       '#attr1': 'job_status',
-                       '#attr2': 's3_key_result_file',
-                       '#attr3': 's3_key_log_file',
-                       '#attr4': 'complete_time',
-                       '#attr5': 's3_results_bucket'
-                    },
-                    ExpressionAttributeValues={
-                       ':new_status': 'COMPLETED', 
-                       ':expected_status': 'RUNNING',
-                       ':result_file': s3_key_name + job_id + "~" + annot_file,
-                       ':log_file': s3_key_name + job_id + "~" + log_file,
-                       ':complete_time': int(time.time()),
-                       ':bucket': bucket_name
-                    }
-                )
-            except Exception as msg:
-                print(f"Oops, could not update DynamoDB: {str(msg)}")
-
-            # annotation job is complete, notify SNS results topic
-            data_obj = {
-                "job_id": job_id,
-                "user_id": user_id,
-                "input_file_name": input_file_name,
-                "complete_time": int(time.time()),
-                "job_status": "COMPLETED",
-                "results_file_location": s3_key_name + job_id + "~" + annot_file,
-                "user_email": user_email
-            }
-            try: 
-                response = sns.publish(
-                    TopicArn=config['aws']['SNSResultsTopicARN'],
-                    Message=json.dumps(data_obj),
-                    MessageStructure='string',
-                )
-            except ParamValidationError as e:
-                print(f"Error: {e}")
-
-            ## https://www.scaler.com/topics/delete-directory-python/
-            # clean up local folder
+"""Annotation options of driver.run from the [annotation] configuration
+"""
+def job_options():
+    global backend, variant_store
+    if backend is None:
+        backend = backends.open_backend(config['annotation']['Backend'],
+            config['annotation']['SQLitePath'] or None)
+    if (variant_store is None) and config['annotation']['VariantStore']:
+        variant_store = VariantStore(config['annotation']['VariantStore'],
+            max_mb=int(config['annotation']['VariantStoreMB']))
+    return {
+        'index_dir': config['annotation']['IntervalIndexDir'] or None,
+        'batch_size': int(config['annotation']['BatchSize']),
+        'sweep': config.getboolean('annotation', 'SweepJoin'),
+        'batch_overlap': config.getboolean('annotation', 'BatchOverlap'),
+        'nclist': config.getboolean('annotation', 'NCList'),
+        'backend': backend,
+        'variant_store': variant_store,
+        'reference_version': config['annotation']['ReferenceVersion']
+    }
+
+
+"""Prepares a process to run jobs: connects to AWS and opens the
+   reference backend, so that every job it runs reuses them
+"""
+def init_worker():
+    connect_aws()
+    job_options()
+
+
+"""Marks a running job FAILED in DynamoDB, with the reason
+"""
+def set_failed(job_id, reason):
+    try:
+        dynamo_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression="SET #attr1 = :new_status, #attr2 = :reason",
+            ConditionExpression="job_status = :expected_status",
+            ExpressionAttributeNames={'#attr1': 'job_status', '#attr2': 'failure_reason'},
+            ExpressionAttributeValues={':new_status': 'FAILED', ':reason': reason,
+                ':expected_status': 'RUNNING'}
+        )
+    except Exception as msg:
+        print(f"Oops, could not update DynamoDB: {str(msg)}")
+
+
+"""Annotates one job's input and publishes its results
+   input_path - local file, or s3:// URL of an input streamed from S3
+   user_role - role of the submitting user; inputs of free users over
+   FreeUserMaxKB once decompressed are not annotated, and the job is
+   marked FAILED
+   Returns 0 once the job is complete (or rejected), 1 if its results
+   could not be uploaded; annotation errors are raised.
+"""
+def run_job(input_path, job_id, input_file_name, user_id, user_email,
+    user_role=None):
+    with Timer():
+        bucket_name = config['aws']['ResultsBucketName']
+
+        # <name>.vcf or <name>.vcf.gz; results are always plain text
+        file_prefix = input_file_name[:-4]
+        if input_file_name.endswith('.gz'):
+            file_prefix = input_file_name[:-7]
+        annot_file = file_prefix + ".annot.vcf"
+        log_file = file_prefix + ".vcf.count.log"
+        stats_file = file_prefix + ".vcf.stats.json"
+        s3_key_name = config['aws']['BucketObjectRoot'] + "/" + user_id + "/"
+
+        # define local job directory to clean up once files are uploaded to S3
+        clean_up_folder = config['annotation_output']['OutputFolder'] + "/" + job_id
+
+        options = job_options()
+        result_keys = {
+            'annot': s3_key_name + job_id + "~" + annot_file,
+            'log': s3_key_name + job_id + "~" + log_file,
+            'stats': s3_key_name + job_id + "~" + stats_file
+        }
+
+        # free users are limited by the size of their input once
+        # decompressed; a streamed input is measured as it is read, so
+        # it is not matched to earlier results
+        max_input_bytes = None
+        if (user_role == 'free_user'):
+            max_input_bytes = int(config['annotation']['FreeUserMaxKB']) * 1024
+        reuse = config.getboolean('annotation', 'ReuseResults') and \
+            ((max_input_bytes is None) or not input_path.startswith('s3://'))
+
+        # the results of an identical input, annotated against the same
+        # reference data, are copied instead of annotating it again
+        index_key = None
+        stats = None
+        try:
+            if reuse and (max_input_bytes is not None):
+                fu.check_size(input_path, max_input_bytes)
+            if reuse:
+                try:
+                    sha = result_index.input_digest(s3_client, input_path)
+                    if sha is not None:
+                        index_key = result_index.index_key(config['aws']['BucketObjectRoot'],
+                            options['reference_version'], sha)
+                        entry = result_index.lookup(s3_client, bucket_name, index_key)
+                        if (entry is not None) and \
+                            result_index.copy_results(s3_client, entry, bucket_name, result_keys):
+                            stats = dict(entry['stats'], reused_from=entry['job_id'])
+                except (ClientError, OSError) as e:
+                    print(f"Could not look up earlier results: {e}")
+
+            if stats is not None:
+                print(f"Reused the results of job {stats['reused_from']}")
+            elif input_path.startswith('s3://'):
+                # streamed from the inputs bucket straight into the results bucket;
+                # an input without a checksum is hashed as it is read, and its
+                # results recorded under that digest
+                results_url = "s3://" + bucket_name + "/"
+                input_sha = hashlib.sha256() if (reuse and (index_key is None)) else None
+                stats = driver.run_s3(s3_client, input_path,
+                    results_url + result_keys['annot'], results_url + result_keys['log'],
+                    'vcf', stats_url=results_url + result_keys['stats'],
+                    max_input_bytes=max_input_bytes, input_sha=input_sha, **options)
+                if input_sha is not None:
+                    index_key = result_index.index_key(config['aws']['BucketObjectRoot'],
+                        options['reference_version'], input_sha.hexdigest())
+            else:
+                stats = driver.run(input_path, 'vcf',
+                    workers=int(config['annotation']['Workers']),
+                    max_input_bytes=max_input_bytes, **options)
+
+                # upload annotation job output files to S3
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+                try:
+                    with open(clean_up_folder + "/" + annot_file, "rb") as file1:
+                        s3_client.upload_fileobj(file1, bucket_name, result_keys['annot'])
+                    with open(clean_up_folder + "/" + log_file, "rb") as file2:
+                        s3_client.upload_fileobj(file2, bucket_name, result_keys['log'])
+                    with open(clean_up_folder + "/" + stats_file, "rb") as file3:
+                        s3_client.upload_fileobj(file3, bucket_name, result_keys['stats'])
+                except ClientError as e:
+                    # not marked COMPLETED: the request is retried
+                    print(f"Could not upload the results of job {job_id}: {e}")
+                    shutil.rmtree(clean_up_folder, ignore_errors=True)
+                    return 1
+        except fu.InputTooLarge as e:
+            # a rejected job is done with; it is not retried
+            print(f"Not annotating job {job_id}: {e}")
+            set_failed(job_id, "Free users can annotate inputs of up to " + \
+                f"{config['annotation']['FreeUserMaxKB']} KB uncompressed")
+            shutil.rmtree(clean_up_folder, ignore_errors=True)
+            return 0
+
+        if (index_key is not None) and ('reused_from' not in stats):
+            result_index.record(s3_client, bucket_name, index_key, job_id,
+                result_keys, stats)
+
+        # update DynamoDB with output files
+        try:
+            dynamo_table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression="SET #attr1 = :new_status, #attr2 = :result_file, #attr3 = :log_file, #attr4 = :complete_time, #attr5 = :bucket, #attr6 = :stats_file, #attr7 = :stats",
+                ConditionExpression="job_status = :expected_status",
+                ExpressionAttributeNames={
+                   '#attr1': 'job_status',
+                   '#attr2': 's3_key_result_file',
+                   '#attr3': 's3_key_log_file',
+                   '#attr4': 'complete_time',
+                   '#attr5': 's3_results_bucket',
+                   '#attr6': 's3_key_stats_file',
+                   '#attr7': 'job_stats'
+                },
+                ExpressionAttributeValues={
+                   ':new_status': 'COMPLETED', 
+                   ':expected_status': 'RUNNING',
+                   ':result_file': result_keys['annot'],
+                   ':log_file': result_keys['log'],
+                   ':complete_time': int(time.time()),
+                   ':bucket': bucket_name,
+                   ':stats_file': result_keys['stats'],
+                   # DynamoDB takes numbers as Decimal, not float
+                   ':stats': json.loads(json.dumps(stats), parse_float=Decimal)
+                }
+            )
+        except Exception as msg:
+            print(f"Oops, could not update DynamoDB: {str(msg)}")
+
+        # annotation job is complete, notify SNS results topic
+        data_obj = {
+            "job_id": job_id,
+            "user_id": user_id,
+            "input_file_name": input_file_name,
+            "complete_time": int(time.time()),
+            "job_status": "COMPLETED",
+            "results_file_location": result_keys['annot'],
+            "user_email": user_email
+        }
+        try: 
+            response = sns.publish(
+                TopicArn=config['aws']['SNSResultsTopicARN'],
+                Message=json.dumps(data_obj),
+                MessageStructure='string',
+            )
+        except ParamValidationError as e:
+            print(f"Error: {e}")
+
+        ## https://www.scaler.com/topics/delete-directory-python/
+        # clean up local folder (streamed jobs have none)
+        if os.path.isdir(clean_up_folder):
             try:
               shutil.rmtree(clean_up_folder)
               print("Directory removed successfully")
             except OSError as o:
                 print(f"Error, {o.strerror}: {clean_up_folder}")
+    return 0
+
+if __name__ == '__main__':
+    # Call the AnnTools pipeline
+    if len(sys.argv) > 1:
+        try:
+            job_id = sys.argv[3]
+            input_file_name = sys.argv[5]
+            user_id = sys.argv[7]
+            user_email = sys.argv[9]
+        except IndexError as e:
+           print("Job ID parameter not given")
+           exit()
+        # requests made before roles were sent have none
+        user_role = sys.argv[11] if len(sys.argv) > 11 else None
+
+        init_worker()
+        sys.exit(run_job(sys.argv[1], job_id, input_file_name, user_id, user_email,
+            user_role or None))
     else:
         print("A valid .vcf file must be provided as input to this program.")
 
@@ -0,0 +1,132 @@
+# s3_stream.py
+#
+# Streaming reads and writes of S3 objects for the annotation pipeline
+#
+# open_input reads an object's body incrementally as text, decompressing
+# gzip/BGZF input on the fly; MultipartWriter uploads text written to it
+# as a multipart upload, one part each time part_size bytes are buffered.
+# Neither keeps more than a buffer of the object in memory or on disk.
+#
+##
+
+import gzip
+import io
+
+# S3 requires every part but the last to be at least 5 MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+
+
+"""Raw binary stream over a botocore StreamingBody
+   sha - optional hashlib object updated with every byte read
+"""
+class _BodyStream(io.RawIOBase):
+    def __init__(self, body, sha=None):
+        self.body = body
+        self.sha = sha
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.body.read(len(b))
+        b[:len(data)] = data
+        if self.sha is not None:
+            self.sha.update(data)
+        return len(data)
+
+    def close(self):
+        self.body.close()
+        io.RawIOBase.close(self)
+
+
+"""Opens s3://bucket/key for reading as text
+   gzip input is recognised by its magic bytes, as in fu.open_vcf.
+   sha - optional hashlib object given the object's bytes (before
+   decompression) as they are read; it holds the digest of the whole
+   object once the text has been read to the end
+"""
+def open_input(s3_client, bucket, key, sha=None):
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    raw = io.BufferedReader(_BodyStream(body, sha), buffer_size=1024 * 1024)
+    if raw.peek(2)[:2] == b'\x1f\x8b':
+        raw = gzip.GzipFile(fileobj=raw, mode='rb')
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+"""Text file object writing to s3://bucket/key through a multipart upload
+   Parts are uploaded as they fill; close() completes the upload. An
+   exception inside a with block aborts it instead, so no partial object
+   is left behind.
+"""
+class MultipartWriter(object):
+    def __init__(self, s3_client, bucket, key, part_size=PART_SIZE,
+        content_type='text/plain'):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.content_type = content_type
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        self._buf = bytearray()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self._buf.extend(data)
+        self.size = self.size + len(data)
+        if (len(self._buf) >= self.part_size):
+            self._upload_part()
+        return len(text)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket,
+                Key=self.key, ContentType=self.content_type)['UploadId']
+        number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+            UploadId=self.upload_id, PartNumber=number, Body=bytes(self._buf))
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+        self._buf = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            # Small enough to never fill a part
+            self.s3.put_object(Bucket=self.bucket, Key=self.key,
+                Body=bytes(self._buf), ContentType=self.content_type)
+            return
+        if (len(self._buf) > 0):
+            self._upload_part()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+            UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                UploadId=self.upload_id)
+
+
+"""(bucket, key) of an s3://bucket/key URL
+"""
+def parse_url(url):
+    (bucket, key) = url[len('s3://'):].split('/', 1)
+    return (bucket, key)
+
+### EOF
@@ -0,0 +1,308 @@
+# snapshot.py
+#
+# Versioned snapshots of the annotator reference tables
+#
+# build() dumps every table driver.run reads into <out_dir>/<version>/,
+# one file per table. A table file is a sequence of frames, each an int64
+# length followed by a zlib-compressed pickle: the first frame holds the
+# column names, every following one a group of up to ROW_GROUP rows
+# stored column by column. manifest.json lists the tables with their row
+# counts, sizes, sha256 checksums and build times.
+#
+# Workers consume a snapshot instead of RDS, either as a SQLite replica
+# (to_sqlite, used with backends.SQLiteBackend) or as interval indexes
+# (build_indexes). Both record their size on disk and build time in
+# manifest.json as well, under 'sqlite' and 'indexes'.
+#
+# Usage:
+#   python snapshot.py build <out_dir> [--version V] [--sqlite DB] [table ...]
+#   python snapshot.py verify <snapshot_dir>
+#   python snapshot.py sqlite <snapshot_dir> <db_path>
+#   python snapshot.py indexes <snapshot_dir> <index_dir> [--nclist]
+#
+##
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import sys
+import time
+import zlib
+from array import array
+
+import backends
+import interval_index as ii
+
+MAGIC = b'ANNSNP01'
+MANIFEST = 'manifest.json'
+ROW_GROUP = 100000
+
+"""Tables read by the annotation stages (see driver.annotators)
+"""
+TABLES = ['dbSNP', 'chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+    'chrom_pos_unequal', 'refGene', 'cpgIslandExt', 'cytoBand', 'gadAll',
+    'gwasCatalog', 'targetScanS', 'hugo', 'dgv_Cnv',
+    'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv',
+    'genomicSuperDups'] + \
+    ['tfbsConsSites' + c for c in [str(i) for i in range(1, 23)] + ['X', 'Y']]
+
+
+"""Writes frames to a table file, hashing what is written
+"""
+class _FrameWriter(object):
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self._write(MAGIC)
+
+    def _write(self, data):
+        self.fh.write(data)
+        self.sha.update(data)
+        self.size = self.size + len(data)
+
+    def frame(self, obj):
+        data = zlib.compress(pickle.dumps(obj,
+            protocol=pickle.HIGHEST_PROTOCOL), 6)
+        self._write(array('q', [len(data)]).tobytes())
+        self._write(data)
+
+    def close(self):
+        self.fh.close()
+
+
+"""Yields the objects stored in the frames of a table file
+"""
+def _frames(path):
+    with open(path, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a snapshot table file: {path}")
+        while True:
+            head = fh.read(8)
+            if (len(head) < 8):
+                break
+            (size,) = array('q', head)
+            yield pickle.loads(zlib.decompress(fh.read(size)))
+
+
+"""Column names and a generator of the rows of a snapshot table
+"""
+def read_table(snapshot_dir, table):
+    frames = _frames(os.path.join(snapshot_dir, table + '.snap'))
+    columns = next(frames)
+
+    def rows():
+        for group in frames:
+            for row in zip(*group):
+                yield row
+
+    return (columns, rows())
+
+
+"""Dumps one table; returns its manifest entry
+"""
+def dump_table(db, table, path):
+    start = time.time()
+    cursor = db.execute('table_dump', table=table)
+    columns = [d[0] for d in cursor.description]
+
+    out = _FrameWriter(path)
+    out.frame(columns)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(ROW_GROUP)
+        if (len(rows) == 0):
+            break
+        out.frame([list(col) for col in zip(*rows)])
+        count = count + len(rows)
+    out.close()
+
+    return {'file': os.path.basename(path), 'columns': columns, 'rows': count,
+        'bytes': out.size, 'sha256': out.sha.hexdigest(),
+        'seconds': round(time.time() - start, 3)}
+
+
+"""Dumps tables from backend (MySQL by default) into out_dir/version
+   Returns the manifest.
+"""
+def build(out_dir, version=None, tables=None, backend=None):
+    backend = backend or backends.MySQLBackend()
+    version = version or time.strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(out_dir, version)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    manifest = {'version': version, 'created': int(time.time()),
+        'format': MAGIC.decode(), 'tables': {}}
+    conn = backend.connect()
+    try:
+        for table in (tables or TABLES):
+            db = backend.queries(conn, stream=True)
+            entry = dump_table(db, table, os.path.join(path, table + '.snap'))
+            db.cursor.close()
+            manifest['tables'][table] = entry
+            print(f"{table}: {entry['rows']} rows, {entry['bytes']} bytes " + \
+                f"in {entry['seconds']:.2f} seconds")
+    finally:
+        conn.close()
+
+    with open(os.path.join(path, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    return manifest
+
+
+def load_manifest(snapshot_dir):
+    with open(os.path.join(snapshot_dir, MANIFEST)) as fh:
+        return json.load(fh)
+
+
+def save_manifest(snapshot_dir, manifest):
+    tmp = os.path.join(snapshot_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(tmp, os.path.join(snapshot_dir, MANIFEST))
+
+
+"""Bytes of the files under path
+"""
+def dir_size(path):
+    size = 0
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            size = size + os.path.getsize(os.path.join(root, name))
+    return size
+
+
+"""Checks every table file against the manifest checksums
+   Returns the names of the tables that do not match.
+"""
+def verify(snapshot_dir):
+    bad = []
+    for table, entry in load_manifest(snapshot_dir)['tables'].items():
+        sha = hashlib.sha256()
+        with open(os.path.join(snapshot_dir, entry['file']), 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                sha.update(block)
+        if (sha.hexdigest() != entry['sha256']):
+            bad.append(table)
+    return bad
+
+
+"""Loads a snapshot into a new SQLite database at db_path, with the
+   indexes of backends.INDEXES, for backends.SQLiteBackend
+   Its size and build time are recorded in the snapshot manifest.
+"""
+def to_sqlite(snapshot_dir, db_path):
+    manifest = load_manifest(snapshot_dir)
+    build_start = time.time()
+    tmp = db_path + '.tmp'
+    if os.path.isfile(tmp):
+        os.unlink(tmp)
+
+    conn = sqlite3.connect(tmp)
+    for table in manifest['tables']:
+        start = time.time()
+        (columns, rows) = read_table(snapshot_dir, table)
+        conn.execute('create table ' + table + ' (' + ', '.join(columns) + ')')
+        conn.executemany('insert into ' + table + ' values (' + \
+            ','.join(['?'] * len(columns)) + ')', rows)
+        print(f"{table}: loaded in {time.time() - start:.2f} seconds")
+    conn.execute('create table ann_snapshot (version)')
+    conn.execute('insert into ann_snapshot values (?)', [manifest['version']])
+    conn.commit()
+    backends.create_indexes(conn)
+    conn.execute('vacuum')
+    conn.close()
+    os.replace(tmp, db_path)
+
+    manifest['sqlite'] = {'file': os.path.abspath(db_path),
+        'bytes': os.path.getsize(db_path),
+        'seconds': round(time.time() - build_start, 3)}
+    save_manifest(snapshot_dir, manifest)
+    print(f"SQLite replica: {manifest['sqlite']['bytes']} bytes in " + \
+        f"{manifest['sqlite']['seconds']:.2f} seconds")
+    return manifest['version']
+
+
+"""Builds the interval indexes of the tables in interval_index.TRACKS
+   from a snapshot
+   The size and build time of every index are recorded in the snapshot
+   manifest; returns those entries.
+"""
+def build_indexes(snapshot_dir, index_dir, kind='sorted'):
+    manifest = load_manifest(snapshot_dir)
+    entries = {}
+    for table in sorted(ii.TRACKS):
+        if table not in manifest['tables']:
+            continue
+        start = time.time()
+        (columns, rows) = read_table(snapshot_dir, table)
+        (c, s, e) = [columns.index(col) for col in ii.TRACKS[table]]
+        ii.build_from_rows(((row[c], row[s], row[e], row) for row in rows),
+            table, index_dir, kind=kind)
+        entries[table] = {'dir': os.path.abspath(os.path.join(index_dir, table)),
+            'kind': kind, 'bytes': dir_size(os.path.join(index_dir, table)),
+            'seconds': round(time.time() - start, 3)}
+        print(f"{table}: {entries[table]['bytes']} bytes indexed in " + \
+            f"{entries[table]['seconds']:.2f} seconds")
+
+    manifest.setdefault('indexes', {}).update(entries)
+    save_manifest(snapshot_dir, manifest)
+    return entries
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='snapshot.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('build')
+    p.add_argument('out_dir')
+    p.add_argument('tables', nargs='*')
+    p.add_argument('--version')
+    p.add_argument('--sqlite', help='dump a SQLite replica instead of MySQL')
+
+    p = commands.add_parser('verify')
+    p.add_argument('snapshot_dir')
+
+    p = commands.add_parser('sqlite')
+    p.add_argument('snapshot_dir')
+    p.add_argument('db_path')
+
+    p = commands.add_parser('indexes')
+    p.add_argument('snapshot_dir')
+    p.add_argument('index_dir')
+    p.add_argument('--nclist', action='store_true')
+
+    args = parser.parse_args(argv)
+    if (args.command == 'build'):
+        backend = backends.SQLiteBackend(args.sqlite) if args.sqlite else None
+        start = time.time()
+        manifest = build(args.out_dir, version=args.version,
+            tables=args.tables or None, backend=backend)
+        size = sum([t['bytes'] for t in manifest['tables'].values()])
+        print(f"Snapshot {manifest['version']}: {size} bytes in " + \
+            f"{time.time() - start:.2f} seconds")
+    elif (args.command == 'verify'):
+        bad = verify(args.snapshot_dir)
+        for table in bad:
+            print(f"{table}: checksum mismatch")
+        return 1 if (len(bad) > 0) else 0
+    elif (args.command == 'sqlite'):
+        version = to_sqlite(args.snapshot_dir, args.db_path)
+        print(f"Snapshot {version} loaded into {args.db_path}")
+    elif (args.command == 'indexes'):
+        entries = build_indexes(args.snapshot_dir, args.index_dir,
+            kind='nclist' if args.nclist else 'sorted')
+        size = sum([t['bytes'] for t in entries.values()])
+        print(f"Indexes: {size} bytes in " + \
+            f"{sum([t['seconds'] for t in entries.values()]):.2f} seconds")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+### EOF
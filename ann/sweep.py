@@ -0,0 +1,90 @@
+# sweep.py
+#
+# Sweep-line join of position-sorted variants against reference intervals
+#
+# When the input is sorted by CHROM/POS the overlap stages do not need a
+# lookup per variant: the intervals of a chromosome are read once, in
+# start order, and kept in a heap of active intervals keyed by end as the
+# variant positions advance. Positions going backwards, or a chromosome
+# coming back after another one, mean the input is not sorted; the join
+# then stops accepting lookups and the caller falls back to its usual
+# per-variant path.
+#
+##
+
+import heapq
+
+
+class SweepJoin(object):
+    """intervals(chrom) returns the (start, end, row) triples of chrom
+       in interval_index.in_row_order; lookups return rows in that order
+    """
+    def __init__(self, intervals, name=''):
+        self.intervals = intervals
+        self.name = name
+        self.sorted = True
+        self.chrom = None
+        self.pos = None
+        self.seen = set()
+        self._stream = None
+        self._pending = None
+        self._active = []
+        self._seq = 0
+
+    """True while the positions seen so far are sorted
+       Once a lookup arrives out of order this is False for good.
+    """
+    def accepts(self, chrom, pos):
+        if not self.sorted:
+            return False
+        if chrom == self.chrom:
+            if pos < self.pos:
+                self._unsorted(chrom, pos)
+        elif chrom in self.seen:
+            self._unsorted(chrom, pos)
+        return self.sorted
+
+    def _unsorted(self, chrom, pos):
+        print(f"{self.name}: input is not sorted at {chrom}:{pos}, " + \
+            "falling back to per-variant lookups")
+        self.sorted = False
+        self._stream = None
+        self._active = []
+
+    def _advance(self, chrom, pos):
+        if chrom != self.chrom:
+            if self.chrom is not None:
+                self.seen.add(self.chrom)
+            self.chrom = chrom
+            self._stream = iter(self.intervals(chrom))
+            self._pending = next(self._stream, None)
+            self._active = []
+        self.pos = pos
+
+        # Intervals that start at or before pos become active
+        while (self._pending is not None) and (self._pending[0] <= pos):
+            (start, end, row) = self._pending
+            heapq.heappush(self._active, (end, self._seq, row))
+            self._seq = self._seq + 1
+            self._pending = next(self._stream, None)
+
+        # Intervals that ended before pos are done
+        while (len(self._active) > 0) and (self._active[0][0] < pos):
+            heapq.heappop(self._active)
+
+    """All rows overlapping pos, in the order of intervals() (fetchall)
+    """
+    def overlapping(self, chrom, pos):
+        self._advance(chrom, pos)
+        return [row for (end, seq, row) in sorted(self._active,
+            key=lambda a: a[1])]
+
+    """First row overlapping pos, or None (fetchone)
+    """
+    def first(self, chrom, pos):
+        self._advance(chrom, pos)
+        if (len(self._active) == 0):
+            return None
+        return min(self._active, key=lambda a: a[1])[2]
+
+### EOF
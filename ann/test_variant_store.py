@@ -0,0 +1,86 @@
+# test_variant_store.py
+#
+# Tests of the variant store size cap
+#
+# Usage:
+#   python -m unittest test_variant_store
+#
+##
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pipeline
+import utils as u
+import variant_store
+
+
+def records(n):
+    inds = u.getFormatSpecificIndices(format='vcf')
+    return [pipeline.Record(['1', str(100 + 10 * i), '.', 'A', 'G', '50',
+        'PASS', 'DP=10'], inds) for i in range(n)]
+
+
+"""Stores every record with an incompressible fragment of size bytes
+"""
+def store_records(store, recs, size=200):
+    capture = store.capture(recs)
+    for i in range(len(recs)):
+        capture.fragments[i].append('+' + os.urandom(size // 2).hex())
+        capture.counts[i].append({})
+    store.put(capture)
+
+
+class CapTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'variants.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_cap_without_many_inserts(self):
+        store = variant_store.VariantStore(self.path, max_mb=1)
+        store.set_version('1')
+        recs = records(9000)
+        for i in range(0, len(recs), 1000):
+            store_records(store, recs[i:i + 1000])
+        self.assertGreater(store.evicted, 0)
+        self.assertLessEqual(store.size(), store.max_bytes)
+        self.assertLessEqual(os.path.getsize(self.path), store.max_bytes * 1.25)
+        store.close()
+
+    def test_cap_checked_when_opened(self):
+        store = variant_store.VariantStore(self.path, max_mb=4)
+        store.set_version('1')
+        store_records(store, records(9000))
+        store.close()
+
+        store = variant_store.VariantStore(self.path, max_mb=1)
+        store.set_version('1')
+        store.connect()
+        self.assertGreater(store.evicted, 0)
+        self.assertLessEqual(store.size(), store.max_bytes)
+        store.close()
+
+    def test_other_versions_dropped_first(self):
+        store = variant_store.VariantStore(self.path, max_mb=4)
+        store.set_version('1')
+        store_records(store, records(9000))
+        store.close()
+
+        store = variant_store.VariantStore(self.path, max_mb=1)
+        store.set_version('2')
+        store.connect()
+        conn = store.connect()
+        self.assertEqual(conn.execute("select count(*) from variants " + \
+            "where version='1'").fetchone()[0], 0)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -13,39 +13,137 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+    ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+# Seconds the RDS secret is reused before it is fetched again
+DB_SECRET_TTL = int(os.environ['ANN_DB_SECRET_TTL']) if \
+    ('ANN_DB_SECRET_TTL' in os.environ) else 300
+
+# Idle connections kept open for reuse, and how long one may sit idle
+# before it is pinged on checkout
+DB_POOL_SIZE = int(os.environ['ANN_DB_POOL_SIZE']) if \
+    ('ANN_DB_POOL_SIZE' in os.environ) else 4
+DB_PING_AFTER = 10
+
+_secret = {'value': None, 'expires': 0}
+
+"""Get RDS secret from AWS Secrets Manager, cached for DB_SECRET_TTL seconds
+"""
+def get_db_secret(refresh=False):
+    if refresh or (_secret['value'] is None) or \
+        (time.time() >= _secret['expires']):
+        asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+            _secret['value'] = json.loads(asm_response['SecretString'])
+            _secret['expires'] = time.time() + DB_SECRET_TTL
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+    return _secret['value']
+
+
+"""Open a new connection to the reference database
+   If the cached credentials are refused (e.g. the secret was rotated)
+   the secret is fetched again and the connection retried once.
+"""
+def db_open():
+    for attempt in (1, 2):
+        rds_secret = get_db_secret(refresh=(attempt == 2))
+        try:
+            return pymysql.connect(
+                host=rds_secret['host'],
+                port=rds_secret['port'],
+                user=rds_secret['username'],
+                passwd=rds_secret['password'],
+                db='annotator',
+                autocommit=True)
+        except pymysql.err.OperationalError as e:
+            # 1045: access denied
+            if (attempt == 2) or (e.args[0] != 1045):
+                raise e
+
+
+"""Pool of open connections shared by the annotation stages, and by
+   successive jobs run in the same process
+   Idle connections are pinged before reuse when they have been idle for
+   more than DB_PING_AFTER seconds; dead ones are dropped. A forked child
+   starts with an empty pool rather than sharing its parent's sockets.
+"""
+class ConnectionPool(object):
+    def __init__(self, size=DB_POOL_SIZE):
+        self.size = size
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = []
+            while len(self.idle) > 0:
+                (conn, since) = self.idle.pop()
+                if (time.time() - since) < DB_PING_AFTER:
+                    return PooledConnection(self, conn)
+                try:
+                    conn.ping(reconnect=False)
+                    return PooledConnection(self, conn)
+                except Exception:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+        return PooledConnection(self, db_open())
+
+    def release(self, conn):
+        with self.lock:
+            if (self.pid == os.getpid()) and conn.open and \
+                (len(self.idle) < self.size):
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for (conn, since) in idle:
+            conn.close()
+
+
+"""Connection checked out of a ConnectionPool
+   close() puts the connection back in the pool; everything else is
+   passed through to the pymysql connection.
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+_pool = ConnectionPool()
+
 """Get connection to reference database
+   Connections come from a process-wide pool; close() returns them to it.
 """
 def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
-
-    # Extract database connection parameters
-    rds_host = rds_secret['host']
-    mysql_port = rds_secret['port']
-    username = rds_secret['username']
-    password = rds_secret['password']
-    database_name = 'annotator'
-
-    # Return a connection to the database
-    return pymysql.connect(
-        host=rds_host,
-        port=mysql_port,
-        user=username,
-        passwd=password,
-        db=database_name)
+    return _pool.get()
 
 
 """Column inices for pileup and VCF
@@ -0,0 +1,341 @@
+# variant_store.py
+#
+# Persistent store of per-variant annotations, shared across jobs
+#
+# A SQLite file keyed by (chrom, pos, ref, alt, reference version) holding,
+# for every annotation stage, the INFO fragment the stage added to the
+# variant and the counts it made for it, plus the final ID field. The
+# pipeline annotates variants found in the store from it and runs the
+# annotators only over the others, adding their results (see
+# pipeline.annotate_batch). Jobs in different processes share the file.
+#
+# A stage's output also depends on whether the input INFO is "." (dbSNP
+# and BigRefGene replace it instead of appending), so that is part of the
+# key; variants whose INFO could change what a stage adds (it already
+# holds a positionType, or starts with ".;" or ends with ";") are never
+# stored. The stored fragments follow the annotator stages: the store is
+# emptied when the list of stages changes.
+#
+# The file is kept under max_mb. Its size is checked when the store is
+# opened, after every batch stored and at the end of every job (see
+# driver.run); once it is past the cap the variants of other reference
+# versions are dropped, then the least recently used ones, and the file
+# is compacted to return the free space to the disk.
+#
+# Usage:
+#   python variant_store.py stats <path>
+#   python variant_store.py compact <path> [--version V] [--max-mb N]
+#
+##
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+
+import pipeline
+
+# Fraction of the cap the store is cut down to when it grows past it
+LOW_WATER = 0.8
+# A hit refreshes the last use of a variant at most this often (seconds)
+TOUCH_INTERVAL = 3600
+
+SCHEMA = [
+    'create table if not exists variants (chrom text, pos integer, ' + \
+        'ref text, alt text, version text, blank integer, value blob, ' + \
+        'used integer)',
+    'create unique index if not exists variants_key on variants ' + \
+        '(chrom, pos, ref, alt, version, blank)',
+    'create index if not exists variants_used on variants (used)',
+    'create table if not exists meta (name text primary key, value text)',
+]
+
+
+"""Results of the annotators over the records missing from the store
+   keys - store key of every record, taken before it is annotated
+   begin() and end() are called around every stage; the annotator's
+   counts are attributed to each record through its tally.
+"""
+class Capture(object):
+    def __init__(self, records, keys):
+        self.records = records
+        self.keys = keys
+        self.fragments = [[] for r in records]
+        self.counts = [[] for r in records]
+        self.storable = [True] * len(records)
+        self._before = None
+
+    def begin(self, annotator):
+        self._before = [r.fields[7] for r in self.records]
+        annotator.tally = {}
+
+    def end(self, annotator):
+        for (i, r) in enumerate(self.records):
+            before = self._before[i]
+            after = r.fields[7]
+            if after.startswith(before):
+                self.fragments[i].append('+' + after[len(before):])
+            elif (before == '.'):
+                # INFO was "." at the start: the stage output replaces it
+                self.fragments[i].append('=' + after)
+            else:
+                self.storable[i] = False
+            self.counts[i].append(annotator.tally.get(r, {}))
+        annotator.tally = None
+        annotator.current = None
+        self._before = None
+
+
+"""Per-variant annotation store at path, kept under max_mb
+   Connects on first use; a store passed to worker processes opens its
+   own connection there.
+"""
+class VariantStore(object):
+    def __init__(self, path, max_mb=1024):
+        self.path = path
+        self.max_bytes = int(max_mb) * 1024 * 1024
+        self.version = None
+        self.conn = None
+        self._stages = None
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['conn'] = None
+        state['_stages'] = None
+        return state
+
+    def connect(self):
+        if self.conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.conn = sqlite3.connect(self.path, timeout=30,
+                check_same_thread=False)
+            self.conn.execute('pragma journal_mode=wal')
+            self.conn.execute('pragma synchronous=normal')
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            self.conn.commit()
+            self.enforce_cap()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    """Reference version of the variants looked up and stored from now on
+    """
+    def set_version(self, version):
+        self.version = '' if (version is None) else str(version)
+
+    """Empties the store if it was filled by a different list of stages
+    """
+    def check_stages(self, annotators):
+        names = json.dumps([pipeline.stage_name(a) for a in annotators])
+        if (names == self._stages):
+            return
+        conn = self.connect()
+        with conn:
+            row = conn.execute("select value from meta where name='stages'").fetchone()
+            if (row is None) or (row[0] != names):
+                if row is not None:
+                    print("Annotation stages changed, emptying the variant store")
+                conn.execute('delete from variants')
+                conn.execute("insert or replace into meta values ('stages', ?)",
+                    [names])
+        self._stages = names
+
+    """Store key of record, or None if its results cannot be stored
+    """
+    def key(self, record):
+        info = record.fields[7]
+        if (info != '.') and (info.startswith('.;') or info.endswith(';') or \
+            ('positionType' in info)):
+            return None
+        return (record.chrom, record.pos, record.ref, record.alt,
+            self.version, int(info == '.'))
+
+    """Annotates the records found in the store from it
+       Returns the records that still have to go through the annotators.
+    """
+    def apply(self, records, annotators):
+        self.check_stages(annotators)
+        conn = self.connect()
+        now = int(time.time())
+        missing = []
+        touched = []
+        for record in records:
+            key = self.key(record)
+            row = None
+            if key is not None:
+                row = conn.execute('select rowid, value, used from variants ' + \
+                    'where chrom=? and pos=? and ref=? and alt=? and ' + \
+                    'version=? and blank=?', key).fetchone()
+            if row is None:
+                missing.append(record)
+                continue
+            (record_id, fragments, counts) = json.loads(zlib.decompress(row[1]))
+            record.fields[2] = record_id
+            for (a, fragment, c) in zip(annotators, fragments, counts):
+                if fragment.startswith('='):
+                    record.fields[7] = fragment[1:]
+                else:
+                    record.fields[7] = record.fields[7] + fragment[1:]
+                for name, n in c.items():
+                    a.count(name, n)
+            if (row[2] < now - TOUCH_INTERVAL):
+                touched.append((now, row[0]))
+        self.hits = self.hits + len(records) - len(missing)
+        self.misses = self.misses + len(missing)
+        if (len(touched) > 0):
+            try:
+                with conn:
+                    conn.executemany('update variants set used=? where rowid=?',
+                        touched)
+            except sqlite3.OperationalError:
+                pass
+        return missing
+
+    """Capture of the results of records as the annotators run
+    """
+    def capture(self, records):
+        return Capture(records, [self.key(r) for r in records])
+
+    """Stores the captured results
+    """
+    def put(self, capture):
+        now = int(time.time())
+        rows = []
+        for (i, record) in enumerate(capture.records):
+            key = capture.keys[i]
+            if (key is None) or not capture.storable[i]:
+                continue
+            value = zlib.compress(json.dumps([record.fields[2],
+                capture.fragments[i], capture.counts[i]]).encode('utf-8'), 6)
+            rows.append(key + (value, now))
+        if (len(rows) == 0):
+            return
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany('insert or replace into variants ' + \
+                    '(chrom, pos, ref, alt, version, blank, value, used) ' + \
+                    'values (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.OperationalError as e:
+            # Another job holds the store; these variants are stored later
+            print(f"Could not update the variant store: {e}")
+            return
+        self.stored = self.stored + len(rows)
+        self.enforce_cap()
+
+    """Bytes used by the variants (the file less its free pages)
+    """
+    def size(self):
+        conn = self.connect()
+        page_size = conn.execute('pragma page_size').fetchone()[0]
+        pages = conn.execute('pragma page_count').fetchone()[0]
+        free = conn.execute('pragma freelist_count').fetchone()[0]
+        return (pages - free) * page_size
+
+    """Brings the store back under its cap once it is over it: drops the
+       variants of other reference versions (once set_version was called),
+       then the least recently used ones down to LOW_WATER of the cap, and
+       compacts the file. Returns how many variants were deleted.
+    """
+    def enforce_cap(self):
+        if (self.size() <= self.max_bytes):
+            return 0
+        return self.compact(self.version)
+
+    """Drops the variants of other reference versions (if version is given),
+       trims the store to LOW_WATER of its cap if it is over it, and
+       shrinks the file; returns how many variants were deleted
+    """
+    def compact(self, version=None):
+        conn = self.connect()
+        deleted = 0
+        try:
+            if version is not None:
+                with conn:
+                    deleted = conn.execute('delete from variants where ' + \
+                        'version != ?', [str(version)]).rowcount
+            size = self.size()
+            if (size > self.max_bytes):
+                count = conn.execute('select count(*) from variants').fetchone()[0]
+                drop = int(count * (1.0 - LOW_WATER * self.max_bytes / size)) + 1
+                with conn:
+                    deleted = deleted + conn.execute('delete from variants ' + \
+                        'where rowid in (select rowid from variants order by ' + \
+                        'used limit ?)', [drop]).rowcount
+            conn.execute('vacuum')
+            conn.execute('pragma wal_checkpoint(truncate)')
+        except sqlite3.OperationalError as e:
+            # Another job holds the store; it is trimmed on a later check
+            print(f"Could not trim the variant store: {e}")
+        self.evicted = self.evicted + deleted
+        return deleted
+
+    """Counts of the store, or their change since an earlier stats()
+    """
+    def stats(self, since=None):
+        stats = {'hits': self.hits, 'misses': self.misses,
+            'stored': self.stored, 'evicted': self.evicted}
+        if since is not None:
+            stats = {name: n - since[name] for (name, n) in stats.items()}
+        return stats
+
+    """Adds counts returned by the stats() of a worker's copy of the store
+    """
+    def merge(self, stats):
+        self.hits = self.hits + stats['hits']
+        self.misses = self.misses + stats['misses']
+        self.stored = self.stored + stats['stored']
+        self.evicted = self.evicted + stats['evicted']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='variant_store.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('stats')
+    p.add_argument('path')
+
+    p = commands.add_parser('compact')
+    p.add_argument('path')
+    p.add_argument('--version', help='keep only this reference version')
+    p.add_argument('--max-mb', type=int, default=1024)
+
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.path):
+        print(f"No variant store at {args.path}")
+        return 1
+    if (args.command == 'stats'):
+        store = VariantStore(args.path)
+        conn = store.connect()
+        for (version, count) in conn.execute('select version, count(*) ' + \
+            'from variants group by version order by version'):
+            print(f"Reference version {version}: {count} variants")
+        print(f"{store.size()} bytes used, {os.path.getsize(args.path)} " + \
+            "bytes on disk")
+    elif (args.command == 'compact'):
+        store = VariantStore(args.path, max_mb=args.max_mb)
+        before = os.path.getsize(args.path)
+        store.compact(version=args.version)
+        print(f"{before} -> {os.path.getsize(args.path)} bytes on disk, " + \
+            f"{store.evicted} variants evicted")
+    store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+### EOF
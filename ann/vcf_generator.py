@@ -0,0 +1,253 @@
+# vcf_generator.py
+#
+# Synthetic VCF files for scale and load testing
+#
+# Generates n variants shaped like the ann/data fixtures: the share of
+# each chromosome, of rs IDs, of indels and of multi-allelic ALTs is
+# measured from the fixtures (see profile), and the INFO field carries
+# AA, AC, AN, DP and the DB flag as they do. Positions are drawn uniformly
+# over GRCh37 chromosome lengths and written sorted, chromosome by
+# chromosome, without holding the variants in memory. The same seed
+# always gives the same file. With --samples, GT:DP genotype columns are
+# added and AC/AN follow from them.
+#
+# Output ending in .gz is gzip compressed; the pipeline, the benchmark
+# (benchmark.py run ... <file>) and the web upload all accept it.
+#
+# Usage:
+#   python vcf_generator.py <out.vcf[.gz]> <variants> [--seed S]
+#       [--samples N] [fixture ...]
+#
+##
+
+import argparse
+import glob
+import gzip
+import os
+import random
+import sys
+
+import file_utils as fu
+import pipeline
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+"""GRCh37 chromosome lengths, in output order
+"""
+CHROM_LENGTHS = [
+    ('1', 249250621), ('2', 243199373), ('3', 198022430), ('4', 191154276),
+    ('5', 180915260), ('6', 171115067), ('7', 159138663), ('8', 146364022),
+    ('9', 141213431), ('10', 135534747), ('11', 135006516), ('12', 133851895),
+    ('13', 115169878), ('14', 107349540), ('15', 102531392), ('16', 90354753),
+    ('17', 81195210), ('18', 78077248), ('19', 59128983), ('20', 63025520),
+    ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566),
+    ('MT', 16569)]
+
+# At most one variant per this many bases of a chromosome
+MIN_SPACING = 4
+# Genotype blocks drawn from per row when there are sample columns
+GENOTYPE_BLOCKS = 64
+BASES = 'ACGT'
+
+
+"""Shares of the variant features in the fixtures
+   Returns a dict with the fraction of variants on every chromosome
+   ('chroms') and of rs IDs, indels and multi-allelic ALTs.
+"""
+def profile(fixtures=None):
+    fixtures = fixtures or sorted(glob.glob(os.path.join(DATA_DIR, '*.vcf')))
+    chroms = {}
+    n = rs = indels = multi = 0
+    for path in fixtures:
+        with fu.open_vcf(path) as fh:
+            for batch in pipeline.read_batches(fh):
+                for record in pipeline.records_of(batch):
+                    n = n + 1
+                    chroms[record.chrom] = chroms.get(record.chrom, 0) + 1
+                    if record.fields[2].startswith('rs'):
+                        rs = rs + 1
+                    if ',' in record.alt:
+                        multi = multi + 1
+                    elif (len(record.alt) != len(record.ref)):
+                        indels = indels + 1
+    n = max(n, 1)
+    return {'chroms': {c: k / n for (c, k) in chroms.items()},
+        'rs': rs / n, 'indels': indels / n, 'multi_allelic': multi / n}
+
+
+"""Number of variants of every chromosome, in output order
+   Shares follow the profile; a chromosome holds at most one variant
+   per MIN_SPACING bases and its excess goes to the others.
+"""
+def chrom_counts(n, shares):
+    lengths = dict(CHROM_LENGTHS)
+    caps = {c: lengths[c] // MIN_SPACING for c in shares if c in lengths}
+    counts = {c: 0 for c in caps}
+    left = n
+    open_chroms = set(caps)
+    while (left > 0) and (len(open_chroms) > 0):
+        total = sum([shares[c] for c in open_chroms])
+        if (total <= 0):
+            total = float(len(open_chroms))
+            weights = {c: 1.0 for c in open_chroms}
+        else:
+            weights = {c: shares[c] for c in open_chroms}
+        # Largest remainder, so the counts add up to what is left
+        exact = {c: left * weights[c] / total for c in open_chroms}
+        share = {c: int(exact[c]) for c in open_chroms}
+        rest = left - sum(share.values())
+        for c in sorted(open_chroms, key=lambda c: share[c] - exact[c])[:rest]:
+            share[c] = share[c] + 1
+        for c in list(open_chroms):
+            take = min(share[c], caps[c] - counts[c])
+            counts[c] = counts[c] + take
+            left = left - take
+            if (counts[c] >= caps[c]):
+                open_chroms.discard(c)
+    if (left > 0):
+        raise ValueError(f"Cannot place {n} variants on the profiled chromosomes")
+    return [(c, counts[c]) for (c, length) in CHROM_LENGTHS if counts.get(c)]
+
+
+"""k sorted distinct positions in [1, length], one at a time
+   Each is drawn as the minimum of the uniform positions still to come,
+   so the sequence has the distribution of k sorted uniform draws.
+"""
+def sorted_positions(rng, k, length):
+    pos = 0
+    for i in range(k):
+        remaining = k - i
+        # Leave room for the positions after this one
+        room = length - pos - (remaining - 1)
+        step = int(room * (1.0 - rng.random() ** (1.0 / remaining)))
+        pos = pos + min(max(step, 1), room)
+        yield pos
+
+
+"""Genotype columns and their (AC, AN) for rows of a sample file
+"""
+def genotype_blocks(rng, samples):
+    blocks = []
+    for b in range(GENOTYPE_BLOCKS):
+        freq = rng.betavariate(0.5, 2.0)
+        cells = []
+        ac = an = 0
+        for s in range(samples):
+            depth = rng.randint(0, 40)
+            if (rng.random() < 0.05):
+                cells.append('./.:' + str(depth))
+                continue
+            alleles = [int(rng.random() < freq), int(rng.random() < freq)]
+            ac = ac + sum(alleles)
+            an = an + 2
+            cells.append(f"{alleles[0]}/{alleles[1]}:{depth}")
+        blocks.append(('\t'.join(cells), ac, an))
+    return blocks
+
+
+def header(seed, samples):
+    lines = ['##fileformat=VCFv4.0',
+        f"##source=vcf_generator.py seed={seed}",
+        '##reference=GRCh37',
+        '##INFO=<ID=AA,Number=1,Type=String,Description="Ancestral Allele">',
+        '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count in genotypes">',
+        '##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles in called genotypes">',
+        '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">',
+        '##INFO=<ID=DB,Number=0,Type=Flag,Description="dbSNP membership">']
+    columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+    if (samples > 0):
+        lines.append('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">')
+        lines.append('##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Read Depth">')
+        columns = columns + ['FORMAT'] + ['SYN' + str(i + 1) for i in range(samples)]
+    return lines + ['\t'.join(columns)]
+
+
+def other_base(rng, base):
+    return rng.choice([b for b in BASES if b != base])
+
+
+"""Writes n variants to out (a text file object); returns n
+"""
+def generate(out, n, seed=0, samples=0, shares=None):
+    shares = shares or profile()
+    rng = random.Random(seed)
+    blocks = genotype_blocks(rng, samples) if (samples > 0) else None
+    for line in header(seed, samples):
+        out.write(line + '\n')
+
+    lengths = dict(CHROM_LENGTHS)
+    lines = []
+    for (chrom, k) in chrom_counts(n, shares['chroms']):
+        for pos in sorted_positions(rng, k, lengths[chrom]):
+            ref = rng.choice(BASES)
+            r = rng.random()
+            if (r < shares['multi_allelic']):
+                alts = [other_base(rng, ref)]
+                alts.append(other_base(rng, ref) if (rng.random() < 0.7) else \
+                    ref + rng.choice(BASES))
+                if (alts[1] == alts[0]):
+                    alts[1] = ref + alts[0]
+            elif (r < shares['multi_allelic'] + shares['indels']):
+                if (rng.random() < 0.5):
+                    alts = [ref + ''.join([rng.choice(BASES)
+                        for i in range(rng.randint(1, 4))])]
+                else:
+                    alts = [ref]
+                    ref = ref + ''.join([rng.choice(BASES)
+                        for i in range(rng.randint(1, 4))])
+            else:
+                alts = [other_base(rng, ref)]
+
+            if blocks is not None:
+                (genotypes, ac, an) = rng.choice(blocks)
+            else:
+                an = rng.randint(2, 200)
+                ac = rng.randint(1, an)
+            counts = [ac] if (len(alts) == 1) else [ac - ac // 3, ac // 3]
+            info = f"AA={ref[0]};AC={','.join([str(c) for c in counts])};" + \
+                f"AN={an};DP={rng.randint(10, 5000)}"
+            if (rng.random() < shares['rs']):
+                rsid = 'rs' + str(rng.randint(1, 999999999))
+                info = info + ';DB'
+            else:
+                rsid = '.'
+
+            fields = [chrom, str(pos), rsid, ref, ','.join(alts),
+                str(rng.randint(10, 999)), 'PASS', info]
+            if blocks is not None:
+                fields = fields + ['GT:DP', genotypes]
+            lines.append('\t'.join(fields))
+            if (len(lines) >= 10000):
+                out.write('\n'.join(lines) + '\n')
+                lines = []
+    if (len(lines) > 0):
+        out.write('\n'.join(lines) + '\n')
+    return n
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='vcf_generator.py')
+    parser.add_argument('out', help='output file; .gz is gzip compressed, - is stdout')
+    parser.add_argument('variants', type=int)
+    parser.add_argument('fixtures', nargs='*',
+        help='VCFs to take the profile from, ann/data/*.vcf by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--samples', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    shares = profile(args.fixtures or None)
+    if (args.out == '-'):
+        generate(sys.stdout, args.variants, seed=args.seed,
+            samples=args.samples, shares=shares)
+        return 0
+    opener = gzip.open if args.out.endswith('.gz') else open
+    with opener(args.out, 'wt') as out:
+        generate(out, args.variants, seed=args.seed, samples=args.samples,
+            shares=shares)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+### EOF
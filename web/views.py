@@ -120,6 +120,7 @@ def create_annotation_job_request():
         "submit_time": int(time.time()),
         "job_status": "PENDING",
         "user_email": session["email"],
+        "user_role": session["role"],
     }
     try:
         dynamo_table.put_item(Item = data_obj)